@@ -0,0 +1,137 @@
+import bisect
+import os
+import os.path
+import threading
+
+import pandas as pd
+
+from Store import Store
+
+"""
+World, per region and top N rollups of the cleansed data, materialised once after every refresh so the dashboard
+never has to sum countries at request time. Everything lives in two small Parquet files,
+
+    data-frames/store/aggregates/rollups.parquet    one row per (scope, name, date): summed counts, ratios, deltas
+    data-frames/store/aggregates/top.parquet        one row per (date, rank): the N countries with the most cases
+
+Countries don't all report on the same days, so before summing every country's latest numbers are carried forward
+to the days it has no row for. Otherwise a world total would drop whenever a country skipped a day.
+"""
+
+
+class Aggregates:
+    counts = [column for column, dtype in Store.columns.items() if dtype.startswith("Int")]
+
+    def __init__(self, path="./data-frames/store/aggregates/", top=10):
+        self.path = path
+        self.top = top
+
+        self.loaded = None
+        self.lock = threading.Lock()
+
+    def get_daily(self, df):
+        # The last row a country has each day, on a full country by date grid with gaps filled from earlier days
+        df = df.assign(date=df["statistic_taken_at"].dt.normalize())
+        df = df.sort_values(["country_name", "statistic_taken_at"], kind="mergesort")
+        df = df.drop_duplicates(["country_name", "date"], keep="last")
+
+        # Regions only arrived with the API snapshots, older rows get the region their country is last seen in
+        region = df["region"].replace("", None)
+        df["region"] = region.groupby(df["country_name"]).transform("last").fillna("")
+
+        grid = pd.MultiIndex.from_product([df["country_name"].unique(), pd.date_range(df["date"].min(),
+                                                                                     df["date"].max())],
+                                          names=["country_name", "date"])
+        df = df.set_index(["country_name", "date"])[["region"] + self.counts].reindex(grid)
+        df = df.groupby(level="country_name").ffill()
+
+        return df.dropna(subset=["region"]).reset_index()
+
+    def rollup(self, daily, scope, by, add_ratios):
+        # Sums per (group, date), then ratios of the sums and the change since the group's previous day
+        keys = [by, "date"] if by is not None else ["date"]
+        df = daily.groupby(keys)[self.counts].sum(min_count=1).astype("Int64").reset_index()
+        df.insert(0, "scope", scope)
+        if by is None:
+            df.insert(1, "name", "")
+        else:
+            df = df.rename(columns={by: "name"})
+
+        df = add_ratios(df)
+        deltas = df.groupby("name")[self.counts].diff()
+        for column in self.counts:
+            df[column + "_delta"] = deltas[column].astype("Int64")
+
+        return df
+
+    def materialize(self, df, add_ratios):
+        # add_ratios(df) adds the deaths/cases% family of columns, Data.add_ratios for the cleansed data
+        if df.empty:
+            return
+
+        daily = self.get_daily(df)
+
+        ranked = daily.assign(rank=daily.groupby("date")["cases"].rank(method="first", ascending=False))
+        top = ranked.loc[ranked["rank"] <= self.top].sort_values(["date", "rank"]).reset_index(drop=True)
+        top["rank"] = top["rank"].astype("int16")
+
+        rollups = pd.concat([self.rollup(daily, "global", None, add_ratios),
+                             self.rollup(daily, "region", "region", add_ratios),
+                             self.rollup(top, "top", None, add_ratios).assign(name="top%d" % self.top)],
+                            ignore_index=True)
+        rollups["scope"] = rollups["scope"].astype("category")
+        rollups["name"] = rollups["name"].astype("category")
+
+        os.makedirs(self.path, exist_ok=True)
+        # The top file goes first, rollups.parquet being replaced is what tells readers there is a new set
+        for name, frame in (("top.parquet", top), ("rollups.parquet", rollups)):
+            temp = os.path.join(self.path, "." + name + ".tmp")
+            frame.to_parquet(temp, index=False)
+            os.replace(temp, os.path.join(self.path, name))
+
+        print("Materialised %d rollup rows and the top %d countries for %d days" %
+              (len(rollups), self.top, daily["date"].nunique()))
+
+    def mtime(self):
+        path = os.path.join(self.path, "rollups.parquet")
+        return os.path.getmtime(path) if os.path.isfile(path) else 0
+
+    def load(self):
+        mtime = self.mtime()
+        with self.lock:
+            if self.loaded is not None and self.loaded[0] == mtime:
+                return self.loaded
+
+        if mtime == 0:
+            rollups, top, days = {}, {}, []
+        else:
+            # Split up front, so a query is a dictionary lookup and a slice of an already date indexed frame
+            df = pd.read_parquet(os.path.join(self.path, "rollups.parquet"))
+            rollups = {key: rows.drop(columns=["scope", "name"]).set_index("date")
+                       for key, rows in df.groupby(["scope", "name"], observed=True)}
+
+            df = pd.read_parquet(os.path.join(self.path, "top.parquet"))
+            top = {date: rows.drop(columns=["date"]).reset_index(drop=True) for date, rows in df.groupby("date")}
+            days = sorted(top)
+
+        with self.lock:
+            self.loaded = (mtime, rollups, top, days)
+            return self.loaded
+
+    def get_names(self, scope):
+        return sorted(name for key_scope, name in self.load()[1] if key_scope == scope)
+
+    def get_rollup(self, scope="global", name="", start_date=None, end_date=None):
+        df = self.load()[1].get((scope, name))
+        if df is None:
+            return None
+
+        return df.loc[start_date:end_date]
+
+    def get_top(self, date=None):
+        mtime, rollups, top, days = self.load()
+
+        # The newest day on or before date
+        i = len(days) if date is None else bisect.bisect_right(days, pd.Timestamp(date))
+
+        return top[days[i - 1]] if i > 0 else None
@@ -0,0 +1,181 @@
+import json
+import os
+import os.path
+import shutil
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from Countries import registry
+from Store import Store
+
+"""
+The cleansed data exported as plain NumPy arrays for the web tier, which maps them instead of reading the Parquet
+store. Rows are sorted by country and then day, so each country is one contiguous slice:
+
+    data-frames/store/arrays/CURRENT            name of the directory holding the current export
+    data-frames/store/arrays/<n>/days.npy       int64 day ordinals (days since 1970-01-01), one per row
+    data-frames/store/arrays/<n>/metrics.npy    float32, one row per metric (Store.columns) by one column per row
+    data-frames/store/arrays/<n>/index.json     metric names, country names, their IDs and regions, row offsets
+
+Loaded with mmap_mode="r", slices of a country are views straight into the mapped files, and every gunicorn worker
+shares the same pages through the OS page cache. Missing values are NaN. A day keeps the last row taken on it.
+
+The newest row of every country is the last of its slice, and a row as of a date is found with one binary search over
+all the countries at once (see get_latest), so headline numbers and pies don't go through whole histories.
+
+Each export goes into a new directory and CURRENT is swapped to it afterwards, workers still mapping the previous
+export keep reading it until they notice the change. Only the newest two exports are kept.
+"""
+
+
+class Arrays:
+    columns = list(Store.columns)
+
+    def __init__(self, path="./data-frames/store/arrays/"):
+        self.path = path
+
+        self.loaded = None
+        self.lock = threading.Lock()
+
+    def mtime(self):
+        path = os.path.join(self.path, "CURRENT")
+        return os.path.getmtime(path) if os.path.isfile(path) else 0
+
+    def exists(self):
+        return self.mtime() != 0
+
+    def export(self, df):
+        df = df.assign(day=df["statistic_taken_at"].to_numpy(dtype="datetime64[D]").astype("int64"))
+        df = df.sort_values(["country_name", "statistic_taken_at"], kind="mergesort")
+        df = df.drop_duplicates(["country_name", "day"], keep="last")
+
+        countries = df.groupby("country_name", sort=False)
+        lengths = countries.size().to_numpy()
+
+        index = {"columns": self.columns,
+                 "countries": list(countries.size().index),
+                 "regions": list(countries["region"].last()),
+                 "ids": registry.get_ids(countries.size().index, register=True).tolist(),
+                 "offsets": [0] + np.cumsum(lengths).tolist()}
+
+        metrics = np.empty((len(self.columns), len(df)), dtype="float32")
+        for i, column in enumerate(self.columns):
+            metrics[i] = df[column].to_numpy(dtype="float32", na_value=np.nan)
+
+        name = str(time.time_ns())
+        os.makedirs(os.path.join(self.path, name))
+        np.save(os.path.join(self.path, name, "days.npy"), df["day"].to_numpy())
+        np.save(os.path.join(self.path, name, "metrics.npy"), metrics)
+        with open(os.path.join(self.path, name, "index.json"), "w") as file:
+            json.dump(index, file)
+
+        temp = os.path.join(self.path, ".CURRENT.tmp")
+        with open(temp, "w") as file:
+            file.write(name)
+        os.replace(temp, os.path.join(self.path, "CURRENT"))
+
+        # Directories are named by creation time, so all but the last two are older than the current one
+        exports = sorted((entry for entry in os.listdir(self.path) if entry.isdigit()), key=int)
+        for entry in exports[:-2]:
+            shutil.rmtree(os.path.join(self.path, entry), ignore_errors=True)
+
+        print("Exported %d rows for %d countries to %s" % (len(df), len(lengths), name))
+
+    def load(self):
+        mtime = self.mtime()
+        with self.lock:
+            if self.loaded is not None and self.loaded[0] == mtime:
+                return self.loaded
+
+        with open(os.path.join(self.path, "CURRENT")) as file:
+            path = os.path.join(self.path, file.read().strip())
+
+        with open(os.path.join(path, "index.json")) as file:
+            index = json.load(file)
+        index["positions"] = {country: i for i, country in enumerate(index["countries"])}
+        index["rows"] = {column: i for i, column in enumerate(index["columns"])}
+
+        days = np.load(os.path.join(path, "days.npy"), mmap_mode="r")
+        offsets = np.array(index["offsets"], dtype="int64")
+
+        # (country position, day) folded into one sorted key per row, for as of lookups of many countries at once
+        index["keys"] = np.repeat(np.arange(len(offsets) - 1, dtype="int64") << 32, np.diff(offsets)) + days
+        index["starts"] = offsets[:-1]
+        index["ends"] = offsets[1:]
+
+        loaded = (mtime, index, days, np.load(os.path.join(path, "metrics.npy"), mmap_mode="r"))
+
+        with self.lock:
+            self.loaded = loaded
+            return loaded
+
+    def get_countries(self):
+        return list(self.load()[1]["countries"])
+
+    def get_slice(self, country, start_date=None, end_date=None):
+        # Rows of one country between two dates, both inclusive, found by binary search on its days
+        mtime, index, days, metrics = self.load()
+
+        position = index["positions"].get(country)
+        if position is None:
+            return slice(0, 0)
+
+        start, end = index["offsets"][position], index["offsets"][position + 1]
+        if start_date is not None:
+            start += int(np.searchsorted(days[start:end], self.get_day(start_date), side="left"))
+        if end_date is not None:
+            end = start + int(np.searchsorted(days[start:end], self.get_day(end_date), side="right"))
+
+        return slice(start, end)
+
+    def get_day(self, date):
+        return pd.Timestamp(date).to_datetime64().astype("datetime64[D]").astype("int64")
+
+    def get_window(self, country, columns, start_date=None, end_date=None):
+        # Views, nothing is copied: the days as datetime64[D] and one float32 array per column
+        mtime, index, days, metrics = self.load()
+        rows = self.get_slice(country, start_date, end_date)
+
+        return days[rows].view("datetime64[D]"), [metrics[index["rows"][column], rows] for column in columns]
+
+    def get_latest(self, countries, columns, date=None):
+        # The newest row of each country, or the newest on or before date: the days as datetime64[D] and a countries by
+        # columns float64 array, NaT and NaN for a country without one
+        mtime, index, days, metrics = self.load()
+
+        positions = np.array([index["positions"].get(country, -1) for country in countries], dtype="int64")
+        known = positions >= 0
+
+        rows = np.full(len(countries), -1, dtype="int64")
+        if date is None:
+            rows[known] = index["ends"][positions[known]] - 1
+        else:
+            rows[known] = np.searchsorted(index["keys"], (positions[known] << 32) + self.get_day(date), side="right") - 1
+            # Nothing on or before the date, the search landed in the previous country
+            rows[known & (rows < index["starts"][np.maximum(positions, 0)])] = -1
+
+        found = rows >= 0
+        dates = np.full(len(countries), np.datetime64("NaT"), dtype="datetime64[D]")
+        dates[found] = days[rows[found]].view("datetime64[D]")
+
+        values = np.full((len(countries), len(columns)), np.nan)
+        values[found] = metrics[np.array([index["rows"][column] for column in columns], dtype="int64")[:, None],
+                                rows[found]].T
+
+        return dates, values
+
+    def get_frame(self, country):
+        # The same shape as a frame from the store, for code that wants a whole country as a DataFrame
+        mtime, index, days, metrics = self.load()
+        dates, values = self.get_window(country, self.columns)
+
+        data = pd.DataFrame(dict(zip(self.columns, values)), index=pd.DatetimeIndex(dates.astype("datetime64[ns]")))
+        position = index["positions"].get(country)
+        data.insert(0, "country_name", country)
+        data.insert(1, "region", index["regions"][position] if position is not None else "")
+        data.insert(2, "statistic_taken_at", data.index)
+
+        return data
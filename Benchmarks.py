@@ -0,0 +1,817 @@
+import argparse
+import ast
+import contextlib
+import importlib.util
+import json
+import math
+import os
+import os.path
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+import plotly.utils
+
+from Aggregates import Aggregates
+from Arrays import Arrays
+from Countries import registry
+from Data import Data
+from Forecast import Forecast
+from Graphs import Graphs
+from Metrics import metrics
+from Snapshots import Snapshots
+from Store import Store
+from Writer import Writer
+
+"""
+Benchmarks for the ingest, storage and rendering hot paths. Nothing here touches the network or the real
+data-frames directory: payloads are generated to look like the ones returned by
+https://rapidapi.com/astsiatsko/api/coronavirus-monitor, served from a local stub server, and every scenario that
+writes files runs in a throwaway copy of the data-frames layout.
+
+Every scenario is run at several sizes (number of countries or length of the history) and reports the best of a
+few runs, the peak memory allocated by Python while it ran and how the time grows with the size. A run exits with 1
+if any scenario raised. Timings depend on the machine, so no baseline is checked in; save one on the machine the
+comparisons run on and later runs are compared against it:
+
+    git checkout <known good commit> && python Benchmarks.py --save-baseline
+    git checkout - && python Benchmarks.py      also exits with 1 if a scenario got more than --tolerance slower
+
+    python Benchmarks.py --quick --only parse_history,scatter
+    python Benchmarks.py --import-profile       where the time goes when a web worker starts
+"""
+
+root = os.path.dirname(os.path.abspath(__file__))
+baseline_path = os.path.join(root, "benchmarks-baseline.json")
+app_path = os.path.join(root, "Covid-19-Tracker.py")
+
+labels = ["cases", "active_cases", "deaths", "total_recovered"]
+
+
+def get_names(countries):
+    # UK first, the app's pages ask for it by name
+    return ["UK"] + ["Country %d" % i for i in range(1, countries)]
+
+
+def history_payload(rows, country="UK", seed=0):
+    rng = random.Random(seed)
+    records = []
+    cases = 0
+    deaths = 0
+
+    for i in range(rows):
+        new_cases = rng.randint(0, 500)
+        new_deaths = rng.randint(0, 50)
+        cases += new_cases
+        deaths += new_deaths
+
+        records.append({"id": str(i),
+                        "country_name": country,
+                        "total_cases": "{:,}".format(cases),
+                        "new_cases": "{:,}".format(new_cases) if i % 7 else None,
+                        "active_cases": "{:,}".format(cases - deaths),
+                        "total_deaths": "{:,}".format(deaths),
+                        "new_deaths": "{:,}".format(new_deaths) if i % 5 else None,
+                        "total_recovered": "{:,}".format(rng.randint(0, cases)),
+                        "serious_critical": "{:,}".format(rng.randint(0, 100)),
+                        "region": None,
+                        "total_cases_per1m": "%.2f" % (cases / 66.0),
+                        "record_date": "2020-03-%02d %02d:%02d:00.000" % (1 + i % 28, i % 24, i % 60)})
+
+    return json.dumps({"country": country, "stat_by_country": records}, separators=(",", ":")).encode("utf-8")
+
+
+def cases_by_country_rows(countries, seed=0):
+    rng = random.Random(seed)
+    rows = []
+
+    for i, name in enumerate(get_names(countries)):
+        cases = rng.randint(0, 300000)
+        rows.append({"country_name": name,
+                     "cases": "{:,}".format(cases),
+                     "deaths": "{:,}".format(rng.randint(0, cases // 10 + 1)),
+                     "region": "",
+                     "total_recovered": "{:,}".format(rng.randint(0, cases)),
+                     "new_deaths": "+{:,}".format(rng.randint(0, 100)) if i % 3 else "",
+                     "new_cases": "+{:,}".format(rng.randint(0, 1000)),
+                     "serious_critical": "{:,}".format(rng.randint(0, 1000)),
+                     "active_cases": "{:,}".format(rng.randint(0, cases)),
+                     "total_cases_per_1m_population": "%.1f" % (cases / 50.0)})
+
+    return rows
+
+
+def cases_by_country_frame(countries, seed=0):
+    return pd.DataFrame(cases_by_country_rows(countries, seed))
+
+
+def cases_by_country_payload(countries, seed=0):
+    return json.dumps({"countries_stat": cases_by_country_rows(countries, seed),
+                       "statistic_taken_at": "2020-04-05 20:15:09"}).encode("utf-8")
+
+
+def affected_payload(countries):
+    return json.dumps({"affected_countries": get_names(countries),
+                       "statistic_taken_at": "2020-04-05 20:15:09"}).encode("utf-8")
+
+
+def world_stats_payload():
+    return json.dumps({"total_cases": "1,263,434", "total_deaths": "68,509", "total_recovered": "260,218",
+                       "new_cases": "61,197", "new_deaths": "3,812",
+                       "statistic_taken_at": "2020-04-05 20:15:09"}).encode("utf-8")
+
+
+def country_frame(days, seed=0):
+    rng = np.random.RandomState(seed)
+    new_cases = rng.randint(0, 500, days)
+    new_deaths = rng.randint(0, 50, days)
+    cases = new_cases.cumsum()
+    deaths = new_deaths.cumsum()
+    recovered = (cases * rng.uniform(0, 0.5, days)).astype(int)
+
+    df = pd.DataFrame({"statistic_taken_at": pd.date_range("2020-01-01", periods=days),
+                       "new_cases": new_cases, "new_deaths": new_deaths, "cases": cases, "deaths": deaths,
+                       "total_recovered": recovered, "active_cases": cases - deaths - recovered})
+    df["deaths/cases%"] = (df["deaths"] / df["cases"] * 100).round(2)
+    df["recovered/cases%"] = (df["total_recovered"] / df["cases"] * 100).round(2)
+    df["active/cases%"] = (df["active_cases"] / df["cases"] * 100).round(2)
+
+    return df
+
+
+def cleansed_frame(countries, days, seed=0):
+    # What cl() leaves in the store: every country's daily history, ending the day before today
+    end = pd.Timestamp(datetime.today().strftime("%Y-%m-%d")) - pd.offsets.Day(1)
+    frames = []
+    for i, name in enumerate(get_names(countries)):
+        df = country_frame(days, seed + i)
+        df["statistic_taken_at"] = pd.date_range(end=end, periods=days)
+        df["country_name"] = name
+        df["region"] = "Region %d" % (i % 6)
+        frames.append(df)
+
+    return pd.concat(frames, ignore_index=True)
+
+
+class StubServer:
+    """
+    Serves fixed payloads by path on 127.0.0.1, so Data can be pointed at it with host=server.host, secure=False.
+    Unknown paths get a 404. Every response waits latency seconds, like a real API would. statuses holds error
+    statuses to answer a path with first, one per request, e.g. {path: [429, 503]} before its payload.
+    """
+
+    def __init__(self):
+        self.payloads = {}
+        self.statuses = {}
+        self.requests = 0
+        self.latency = 0
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body go out in two writes, with Nagle on the client's delayed ACK held every response ~40 ms
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                stub.requests += 1
+                time.sleep(stub.latency)
+                if stub.statuses.get(self.path):
+                    status, body = stub.statuses[self.path].pop(0), b'{"message": "stub error"}'
+                else:
+                    body = stub.payloads.get(self.path)
+                    status = 404 if body is None else 200
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(body or b"")))
+                self.end_headers()
+                self.wfile.write(body or b"")
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.host = "127.0.0.1:%d" % self.server.server_port
+        self.thread = threading.Thread(target=self.server.serve_forever, name="stub-server", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class Environment:
+    """
+    A stub server and an empty data-frames layout in a temporary directory, which is the working directory while
+    the benchmarks run since Data, Store and Graphs all use paths relative to it.
+    """
+
+    folders = ["cases-by-country", "countries-affected", "countries-affected-history", "global-data", "pre-api"]
+
+    def __init__(self):
+        self.path = tempfile.mkdtemp(prefix="covid-19-benchmarks-")
+        self.cwd = os.getcwd()
+        self.server = StubServer().start()
+
+        # Spans are still timed and counted, just not written to the real log
+        self.log_path = metrics.log_path
+        metrics.log_path = None
+
+    def reset(self):
+        os.chdir(self.path)
+        shutil.rmtree("data-frames", ignore_errors=True)
+        self.server.latency = 0
+        for folder in self.folders:
+            os.makedirs(os.path.join("data-frames", folder))
+
+        # Class level caches would otherwise hand one scenario's frames to the next
+        Graphs.cache.clear()
+        Graphs.figures.clear()
+
+    def close(self):
+        os.chdir(self.cwd)
+        metrics.log_path = self.log_path
+        self.server.stop()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def new_data(server=None):
+    # A Data that hasn't run a refresh, with just enough state for the method being measured
+    data = Data.__new__(Data)
+    data.coerced = {}
+    data.date = datetime.today().strftime("%Y-%m-%d")
+    data.workers = 8
+    data.headers = {}
+    data.retries = 0
+    data.backoff = 0
+    data.connections = threading.local()
+    data.fetch_state = {}
+    data.fetched = {}
+    data.fetch_lock = threading.Lock()
+    data.cases_changed = True
+    data.store = Store()
+    data.writer = Writer()
+    data.aggregates = Aggregates()
+    if server is not None:
+        data.host = server.host
+        data.secure = False
+
+    return data
+
+
+def legacy_parse_history(data, country="UK"):
+    # The string splitting parser get_history_by_affected_country used before switching to json. DataFrame.append
+    # was a thin wrapper around concat so it is reproduced with concat here.
+    data = data.decode("utf-8")
+    data = data.replace('{"country":"%s","stat_by_country":[' % country, "").replace("]", "") \
+        .replace("null", '"null"').split("},")
+    df = pd.DataFrame()
+
+    for i in range(len(data)):
+        if country in data[i]:
+            if i != len(data) - 1:
+                row = ast.literal_eval(data[i] + "}")
+            else:
+                row = ast.literal_eval(data[i][:-1])
+            df = pd.concat([df, pd.DataFrame([row])], ignore_index=True)
+
+    return df
+
+
+def legacy_steralize(column, type):
+    # What Data used to clean a column with before sanitize
+    return pd.to_numeric(column.str.replace(",", "").astype(type, errors='ignore'), errors="coerce")
+
+
+def legacy_sanitize(data, df):
+    for column, dtype in data.schemas["cases_by_country"].items():
+        df[column] = legacy_steralize(df[column], int if dtype.startswith("Int") else float)
+    return df
+
+
+def load_app():
+    os.environ["REFRESH_IN_APP"] = "0"
+    spec = importlib.util.spec_from_file_location("tracker", app_path)
+    tracker = importlib.util.module_from_spec(spec)
+    # Flask looks its root path (templates, static files) up through sys.modules, see wsgi.py
+    sys.modules[spec.name] = tracker
+    spec.loader.exec_module(tracker)
+
+    return tracker
+
+
+# Scenarios take a size and the environment, do their setup and return the function to be timed
+
+
+def parse_history(rows, env):
+    data = new_data()
+    payload = history_payload(rows)
+
+    return lambda: data.parse_history(payload)
+
+
+def legacy_parse(rows, env):
+    payload = history_payload(rows)
+
+    return lambda: legacy_parse_history(payload)
+
+
+def fetch_history(rows, env):
+    # get_history_by_affected_country end to end, request to the stub server included
+    data = new_data(env.server)
+    env.server.payloads["/coronavirus/cases_by_particular_country.php?country=UK"] = history_payload(rows)
+
+    return lambda: data.get_history_by_affected_country("UK")
+
+
+def sanitize(countries, env):
+    data = new_data()
+    df = cases_by_country_frame(countries)
+
+    return lambda: data.sanitize(df.copy(), "cases_by_country")
+
+
+def steralize(countries, env):
+    data = new_data()
+    df = cases_by_country_frame(countries)
+
+    return lambda: legacy_sanitize(data, df.copy())
+
+
+def update_cleansed_data(countries, env, days=60):
+    env.reset()
+    data = new_data()
+    data.store.upsert_many(cleansed_frame(countries, days))
+
+    df = data.sanitize(cases_by_country_frame(countries), "cases_by_country")
+    df["statistic_taken_at"] = "%s 12:00:00" % data.date
+    data.save(df, "./data-frames/cases-by-country/cases-by-country_%s.pkl" % data.date).result()
+    data.affected_countries = pd.DataFrame({"affected_countries": get_names(countries)})
+
+    return data.update_cleansed_data
+
+
+def materialize(countries, env, days=60):
+    env.reset()
+    data = new_data()
+    data.store.upsert_many(cleansed_frame(countries, days))
+
+    return lambda: data.aggregates.materialize(data.store.read(),
+                                               lambda df: data.add_ratios(df, "cases_by_country"))
+
+
+def refresh(countries, env, latency=0):
+    # A whole Data refresh, every country's history included, against the stub server
+    env.reset()
+    env.server.latency = latency
+    env.server.payloads.update({"/coronavirus/affected.php": affected_payload(countries),
+                                "/coronavirus/cases_by_country.php": cases_by_country_payload(countries),
+                                "/coronavirus/worldstat.php": world_stats_payload()})
+    for name in get_names(countries):
+        env.server.payloads["/coronavirus/cases_by_particular_country.php?country=%s" %
+                            name.replace(" ", "%20")] = history_payload(60, name)
+
+    def run():
+        # Without this every run after the first would only see unchanged payloads
+        if os.path.isfile(Data.fetch_state_path):
+            os.remove(Data.fetch_state_path)
+        Data(key="benchmark", getWorldHistoryData=True, host=env.server.host, secure=False, retries=0)
+
+    return run
+
+
+def refresh_latency(countries, env):
+    # The same with 50 ms per request, where fetching, parsing and writing overlap
+    return refresh(countries, env, latency=0.05)
+
+
+def write_snapshots(days, countries=200):
+    # One cases by country pickle per day, the way a refresh leaves them
+    dates = pd.date_range("2020-03-18", periods=days).strftime("%Y-%m-%d")
+    for i, date in enumerate(dates):
+        df = cases_by_country_frame(countries, seed=i).assign(statistic_taken_at=date + " 20:15:09")
+        df.to_pickle("./data-frames/cases-by-country/cases-by-country_%s.pkl" % date)
+
+    return list(dates)
+
+
+def snapshots_range(days, env):
+    # Five countries' cases over the whole history from the catalog
+    env.reset()
+    write_snapshots(days)
+    snapshots = Snapshots()
+    snapshots.compact()
+    names = get_names(5)
+
+    return lambda: snapshots.read("cases_by_country", countries=names, columns=["cases"])
+
+
+def snapshots_pickles(days, env):
+    # The same by opening every day's pickle
+    env.reset()
+    dates = write_snapshots(days)
+    names = get_names(5)
+
+    def run():
+        frames = []
+        for date in dates:
+            df = pd.read_pickle("./data-frames/cases-by-country/cases-by-country_%s.pkl" % date)
+            frames.append(df.loc[df["country_name"].isin(names), ["country_name", "statistic_taken_at", "cases"]])
+        return pd.concat(frames)
+
+    return run
+
+
+def canonicalize(rows, env):
+    # Names the way the ECDC csv spells them, 200 countries repeated over every row, to their canonical names
+    names = pd.Series(np.array([name.replace(" ", "_") for name in get_names(200)], dtype=object)[
+        np.arange(rows) % 200])
+
+    return lambda: registry.canonicalize(names, register=False)
+
+
+def long_data(countries, env, days=120, mapped=False):
+    # Cold reads of every country for one chart, from the Parquet store or the mapped export
+    env.reset()
+    store = Store()
+    store.upsert_many(cleansed_frame(countries, days))
+    if mapped:
+        Arrays().export(store.read())
+
+    graphs = Graphs.__new__(Graphs)
+    graphs.store = store
+    graphs.arrays = Arrays()
+    names = get_names(countries)
+
+    def run():
+        Graphs.cache.clear()
+        graphs.get_long_data(labels, names)
+
+    return run
+
+
+def long_data_mapped(countries, env):
+    return long_data(countries, env, mapped=True)
+
+
+def forecast_run(countries, env, days=60):
+    # Every model fitted to two metrics of every country from scratch, process pool start included
+    env.reset()
+    Store().upsert_many(cleansed_frame(countries, days))
+    graphs = Graphs()
+    names = get_names(countries)
+
+    def run():
+        for path in (graphs.fits.path, "./data-frames/forecasts/forecasts.pkl"):
+            if os.path.isfile(path):
+                os.remove(path)
+        graphs.fits.entries = None
+        Forecast(graphs).run(names, ["cases", "deaths"], "2020-01-01", 14)
+
+    return run
+
+
+def get_graphs(countries, days):
+    graphs = Graphs.__new__(Graphs)
+    names = get_names(countries)
+    df = graphs.index_by_date(country_frame(days))
+
+    return graphs, names, df
+
+
+def scatter(countries, env, days=120, points=None, bulk=True):
+    graphs, names, df = get_graphs(countries, days)
+
+    # Serialised too, that is where a point budget saves the most
+    return lambda: graphs.get_json(graphs.scatter("Cases", labels, names, start_date="2020-01-15", df=df,
+                                                  points=points, bulk=bulk))
+
+
+def scatter_loop(countries, env):
+    # One add_trace call per country and label, what the bulk path replaced
+    return scatter(countries, env, bulk=False)
+
+
+def scatter_history(days, env, countries=20):
+    return scatter(countries, env, days)
+
+
+def scatter_downsampled(days, env, countries=20):
+    return scatter(countries, env, days, points=500)
+
+
+def pi(countries, env, days=120):
+    graphs, names, df = get_graphs(countries, days)
+
+    return lambda: graphs.pi("", ["cases"], names, date="2020-03-01", df=df)
+
+
+def pi_mapped(countries, env, days=120):
+    # The same from the latest values index of the mapped export, as the home page does it
+    env.reset()
+    store = Store()
+    store.upsert_many(cleansed_frame(countries, days))
+    Arrays().export(store.read())
+
+    graphs = Graphs.__new__(Graphs)
+    graphs.store = store
+    graphs.arrays = Arrays()
+    names = get_names(countries)
+
+    return lambda: graphs.get_json(graphs.pi("", ["cases"], names, date="2020-03-01", as_dict=True))
+
+
+def get_json(countries, env, days=120, as_dict=False):
+    graphs, names, df = get_graphs(countries, days)
+    fig = graphs.scatter("Cases", labels, names, start_date="2020-01-15", df=df, as_dict=as_dict)
+
+    return lambda: graphs.get_json(fig)
+
+
+def get_json_legacy(countries, env, days=120):
+    # plotly's own encoder, what get_json replaced
+    graphs, names, df = get_graphs(countries, days)
+    fig = graphs.scatter("Cases", labels, names, start_date="2020-01-15", df=df)
+
+    return lambda: json.dumps(fig, cls=plotly.utils.PlotlyJSONEncoder)
+
+
+def get_json_dict(countries, env):
+    # What the app serves, typed arrays and dates as a start and a step instead of a plotly figure
+    return get_json(countries, env, as_dict=True)
+
+
+def scatter_dict(countries, env, days=120):
+    graphs, names, df = get_graphs(countries, days)
+
+    return lambda: graphs.get_json(graphs.scatter("Cases", labels, names, start_date="2020-01-15", df=df,
+                                                  as_dict=True))
+
+
+def get_client(countries, env, days=60):
+    env.reset()
+    Store().upsert_many(cleansed_frame(countries, days))
+    pd.to_pickle(pd.DataFrame({"affected_countries": get_names(countries)}),
+                 "./data-frames/countries-affected/countries-affected_%s.pkl" % datetime.today().strftime("%Y-%m-%d"))
+
+    return load_app().app.test_client()
+
+
+def get_routes(client, routes, cold):
+    def run():
+        if cold:
+            Graphs.figures.clear()
+            Graphs.cache.clear()
+        for route in routes:
+            response = client.get(route)
+            if response.status_code != 200:
+                raise RuntimeError("%s returned %d" % (route, response.status_code))
+
+    return run
+
+
+def spans(count, env, enabled=True):
+    def run():
+        metrics.enabled = enabled
+        try:
+            for i in range(count):
+                with metrics.span("benchmark"):
+                    pass
+        finally:
+            metrics.enabled = True
+
+    return run
+
+
+def spans_disabled(count, env):
+    return spans(count, env, enabled=False)
+
+
+def get_worker_env():
+    env = dict(os.environ, PRECOMPUTE="0", REFRESH_IN_APP="0")
+    env["PYTHONPATH"] = os.pathsep.join(path for path in [root, env.get("PYTHONPATH")] if path)
+    return env
+
+
+def cold_start(countries, env):
+    # What a new gunicorn worker pays before it can answer, in a fresh interpreter
+    get_client(countries, env)
+    Arrays().export(Store().read())
+
+    def run():
+        subprocess.run([sys.executable, "-c", "import wsgi"], env=get_worker_env(), check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    return run
+
+
+def import_profile(module="wsgi", top=15):
+    # python -X importtime, the time spent in each module itself summed up per top level package
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import %s" % module], env=get_worker_env(),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+
+    packages = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_time, cumulative, name = line[len("import time:"):].split("|")
+        package = name.strip().split(".")[0]
+        packages[package] = packages.get(package, 0) + int(self_time)
+
+    total = sum(packages.values())
+    print("import %s: %.3f s" % (module, total / 1e6))
+    for package, spent in sorted(packages.items(), key=lambda item: -item[1])[:top]:
+        print("    %-24s %8.3f s  %5.1f%%" % (package, spent / 1e6, spent / total * 100))
+    if result.returncode:
+        print(result.stderr.strip().splitlines()[-1])
+
+
+def flask_pages(countries, env, cold=True):
+    return get_routes(get_client(countries, env), ["/", "/UK"], cold)
+
+
+def flask_api(countries, env, cold=True):
+    names = ",".join(get_names(countries))
+    routes = ["/api/series?countries=%s&start_date=2020-01-01" % names,
+              "/api/values?countries=%s" % names,
+              "/api/chart/scatter?countries=%s&labels=cases" % names]
+
+    return get_routes(get_client(countries, env), routes, cold)
+
+
+def flask_api_warm(countries, env):
+    return flask_api(countries, env, cold=False)
+
+
+# name: (scenario, what the size counts, sizes, sizes with --quick)
+scenarios = OrderedDict([
+    ("parse_history", (parse_history, "row", [1000, 10000, 100000], [1000, 10000])),
+    ("legacy_parse", (legacy_parse, "row", [250, 500, 1000], [250, 500])),
+    ("fetch_history", (fetch_history, "row", [1000, 10000, 100000], [1000, 10000])),
+    ("sanitize", (sanitize, "country", [200, 2000, 20000], [200, 2000])),
+    ("steralize", (steralize, "country", [200, 2000, 20000], [200, 2000])),
+    ("update_cleansed_data", (update_cleansed_data, "country", [50, 200, 800], [50, 200])),
+    ("materialize", (materialize, "country", [50, 200, 800], [50, 200])),
+    ("refresh", (refresh, "country", [20, 100, 200], [20, 50])),
+    ("refresh_latency", (refresh_latency, "country", [20, 100, 200], [20, 50])),
+    ("snapshots_range", (snapshots_range, "day", [30, 365, 1000], [30, 365])),
+    ("snapshots_pickles", (snapshots_pickles, "day", [30, 365, 1000], [30, 365])),
+    ("canonicalize", (canonicalize, "row", [10000, 100000, 1000000], [10000, 100000])),
+    ("long_data", (long_data, "country", [10, 50], [10])),
+    ("long_data_mapped", (long_data_mapped, "country", [10, 50, 400], [10, 50])),
+    ("forecast_run", (forecast_run, "country", [10, 50, 200], [10, 50])),
+    ("scatter", (scatter, "country", [10, 100, 400], [10, 100])),
+    ("scatter_loop", (scatter_loop, "country", [10, 100, 400], [10, 100])),
+    ("scatter_history", (scatter_history, "day", [30, 365, 3650], [30, 365])),
+    ("scatter_downsampled", (scatter_downsampled, "day", [30, 365, 3650], [30, 365])),
+    ("pi", (pi, "country", [10, 100, 400], [10, 100])),
+    ("pi_mapped", (pi_mapped, "country", [10, 100, 400], [10, 100])),
+    ("get_json", (get_json, "country", [10, 100, 400], [10, 100])),
+    ("get_json_legacy", (get_json_legacy, "country", [10, 100, 400], [10, 100])),
+    ("get_json_dict", (get_json_dict, "country", [10, 100, 400], [10, 100])),
+    ("scatter_dict", (scatter_dict, "country", [10, 100, 400], [10, 100])),
+    ("spans", (spans, "span", [1000, 10000], [1000])),
+    ("spans_disabled", (spans_disabled, "span", [1000, 10000], [1000])),
+    ("cold_start", (cold_start, "country", [10, 200], [10])),
+    ("flask_pages", (flask_pages, "country", [10, 100], [10])),
+    ("flask_api", (flask_api, "country", [10, 100], [10])),
+    ("flask_api_warm", (flask_api_warm, "country", [10, 100], [10])),
+])
+
+
+def measure(scenario, size, env, repeat):
+    # Setup output (and the data frames Data prints) would bury the report
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        run = scenario(size, env)
+
+        seconds = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            run()
+            seconds.append(time.perf_counter() - start)
+
+        # A separate run for memory, tracemalloc slows everything down too much to time with it on
+        tracemalloc.start()
+        try:
+            run()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    return {"seconds": min(seconds), "peak_mib": peak / 2 ** 20}
+
+
+def get_exponent(results):
+    # Slope of log(time) against log(size) between the smallest and largest size, 1 is linear
+    sizes = sorted(int(size) for size, result in results.items() if "seconds" in result)
+    if len(sizes) < 2:
+        return None
+
+    first = results[str(sizes[0])]["seconds"]
+    last = results[str(sizes[-1])]["seconds"]
+    return math.log(last / first) / math.log(sizes[-1] / sizes[0])
+
+
+def run(names, quick=False, repeat=3, baseline=None, tolerance=0.25):
+    env = Environment()
+    results = OrderedDict()
+    regressions = []
+    errors = []
+
+    try:
+        for name in names:
+            scenario, unit, sizes, quick_sizes = scenarios[name]
+            results[name] = OrderedDict()
+
+            for size in quick_sizes if quick else sizes:
+                try:
+                    result = measure(scenario, size, env, repeat)
+                except Exception as e:
+                    results[name][str(size)] = {"error": "%s: %s" % (type(e).__name__, e)}
+                    errors.append((name, size))
+                    print("%-22s %8d %-8s  failed  %s" % (name, size, unit, results[name][str(size)]["error"]))
+                    continue
+
+                line = "%-22s %8d %-8s %9.4f s %10.2f us/%-8s %8.1f MiB peak" % (
+                    name, size, unit, result["seconds"], result["seconds"] / size * 1e6, unit, result["peak_mib"])
+
+                previous = (baseline or {}).get(name, {}).get(str(size), {}).get("seconds")
+                if previous:
+                    change = result["seconds"] / previous - 1
+                    line += "  %+6.1f%% vs baseline" % (change * 100)
+                    if change > tolerance:
+                        line += "  REGRESSION"
+                        regressions.append((name, size, change))
+
+                results[name][str(size)] = result
+                print(line)
+
+            exponent = get_exponent(results[name])
+            if exponent is not None:
+                print("%-22s scales as %s^%.2f" % ("", unit, exponent))
+    finally:
+        env.close()
+
+    return results, regressions, errors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the ingest, storage and rendering hot paths")
+    parser.add_argument("--only", help="comma separated scenarios, one of %s" % ", ".join(scenarios))
+    parser.add_argument("--quick", action="store_true", help="only the smaller sizes")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per size, the fastest is reported")
+    parser.add_argument("--baseline", default=baseline_path, help="baseline to compare against / save to")
+    parser.add_argument("--save-baseline", action="store_true", help="save the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="slowdown reported as a regression")
+    parser.add_argument("--import-profile", action="store_true", help="profile importing the app and exit")
+    args = parser.parse_args()
+
+    if args.import_profile:
+        import_profile()
+        sys.exit(0)
+
+    names = args.only.split(",") if args.only else list(scenarios)
+    unknown = [name for name in names if name not in scenarios]
+    if unknown:
+        parser.error("unknown scenarios: %s" % ", ".join(unknown))
+
+    baseline = None
+    if not args.save_baseline and os.path.isfile(args.baseline):
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    elif not args.save_baseline:
+        print("No baseline at %s, nothing to compare against. Save one with --save-baseline" % args.baseline)
+
+    results, regressions, errors = run(names, args.quick, args.repeat, baseline, args.tolerance)
+
+    if args.save_baseline:
+        # Keep the scenarios and sizes that weren't run this time or failed
+        saved = {}
+        if os.path.isfile(args.baseline):
+            with open(args.baseline) as file:
+                saved = json.load(file)
+        for name, sizes in results.items():
+            saved.setdefault(name, {}).update((size, result) for size, result in sizes.items() if "error" not in result)
+        with open(args.baseline, "w") as file:
+            json.dump(saved, file, indent=1)
+        print("Saved baseline to %s" % args.baseline)
+
+    if errors:
+        print("%d scenario size(s) failed: %s" % (len(errors), ", ".join("%s %d" % error for error in errors)))
+    if regressions:
+        print("%d regression(s) over %.0f%%" % (len(regressions), args.tolerance * 100))
+    if errors or regressions:
+        sys.exit(1)
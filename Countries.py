@@ -0,0 +1,224 @@
+import contextlib
+import json
+import os
+import os.path
+import re
+import tempfile
+import threading
+import unicodedata
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import numpy as np
+import pandas as pd
+
+"""
+One name and one integer ID for every country, whichever source the name came from. The API, the ECDC csv (which
+later spells names with underscores, e.g. United_Kingdom) and file names written on other systems (Réunion can come
+back decomposed, as an "e" and a combining accent) all resolve to the same country.
+
+Names are matched on a key: accents dropped, case folded and underscores, dashes, dots, commas and apostrophes
+treated as spaces, so "Curacao", "Curaçao" and "CURAÇAO" are one country. Names that differ by more than that are
+listed in aliases. The canonical name is the API's, as that is what the data is stored under.
+
+IDs are the position of a country in
+
+    data-frames/countries.json    the canonical names, new countries are appended the first time they are seen
+
+so they stay the same from one run to the next, and a categorical of country names with the registry's names as its
+categories has the IDs as its codes.
+
+Only ingest (Data and the stores it writes) registers new countries. Everything else looks names up as they are and
+reads the file again whenever it has changed, so a web worker sees the IDs a refresh in another process handed out.
+Registering happens under a lock on countries.json.lock, a process adding names first reads what others have added.
+"""
+
+# Key of a name other sources use: the API's name for the country
+aliases = {
+    "united kingdom": "UK", "great britain": "UK",
+    "united states of america": "USA", "united states": "USA", "us": "USA",
+    "south korea": "S. Korea", "korea south": "S. Korea", "republic of korea": "S. Korea",
+    "united arab emirates": "UAE",
+    "central african republic": "CAR",
+    "democratic republic of the congo": "DRC", "congo kinshasa": "DRC",
+    "republic of the congo": "Congo", "congo brazzaville": "Congo",
+    "czech republic": "Czechia",
+    "cote divoire": "Ivory Coast", "cote d ivoire": "Ivory Coast",
+    "faroe islands": "Faeroe Islands",
+    "macau": "Macao",
+    "cape verde": "Cabo Verde",
+    "holy see": "Vatican City",
+    "saint vincent and the grenadines": "St. Vincent Grenadines",
+    "saint barthelemy": "St. Barth",
+    "saint pierre and miquelon": "Saint Pierre Miquelon",
+    "turks and caicos islands": "Turks and Caicos",
+    "bonaire saint eustatius and saba": "Caribbean Netherlands",
+    "east timor": "Timor-Leste",
+    "swaziland": "Eswatini",
+    "macedonia": "North Macedonia",
+    "burma": "Myanmar",
+    "viet nam": "Vietnam",
+    "russian federation": "Russia",
+    "syrian arab republic": "Syria",
+    "lao peoples democratic republic": "Laos",
+    "brunei darussalam": "Brunei",
+    "united republic of tanzania": "Tanzania",
+    "occupied palestinian territory": "Palestine",
+    "cases on an international conveyance japan": "Diamond Princess",
+}
+
+separators = re.compile(r"[\s_\-.,'()]+")
+
+
+def normalize(name):
+    # The composed form, what the API sends and what goes into URLs and file names
+    return unicodedata.normalize("NFC", str(name)).strip()
+
+
+def get_key(name):
+    name = unicodedata.normalize("NFKD", str(name))
+    name = "".join(character for character in name if not unicodedata.combining(character))
+
+    return separators.sub(" ", name.casefold()).strip()
+
+
+class Countries:
+
+    def __init__(self, path="./data-frames/countries.json"):
+        self.path = path
+
+        self.names = None
+        self.ids = None
+        self.version = None
+        self.lock = threading.Lock()
+
+    def get_version(self):
+        # Names are only ever appended, so the size changes even when the mtime doesn't
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+
+        return stat.st_mtime_ns, stat.st_size
+
+    def load(self):
+        # Called with the lock held. Saved names keep their IDs, countries only known from aliases come after them
+        version = self.get_version()
+        if self.names is not None and version == self.version:
+            return
+
+        saved = []
+        if version is not None:
+            with open(self.path) as file:
+                saved = json.load(file)
+
+        self.names = []
+        self.ids = {}
+        for name in saved + sorted(set(aliases.values())):
+            self.add(name)
+        for alias, name in aliases.items():
+            self.ids.setdefault(alias, self.ids[get_key(name)])
+        self.version = version
+
+    def add(self, name):
+        key = get_key(name)
+        if key not in self.ids:
+            self.ids[key] = len(self.names)
+            self.names.append(normalize(name))
+
+        return self.ids[key]
+
+    @contextlib.contextmanager
+    def locked(self):
+        # Across processes, the lock attribute only keeps out other threads of this one
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+        if fcntl is None:
+            yield
+            return
+
+        with open(self.path + ".lock", "a") as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+
+    def save(self):
+        # Called with both locks held
+        directory = os.path.dirname(self.path)
+        descriptor, temp = tempfile.mkstemp(prefix=".countries.json.", suffix=".tmp", dir=directory)
+        try:
+            with os.fdopen(descriptor, "w") as file:
+                json.dump(self.names, file, ensure_ascii=False, indent=0)
+            os.replace(temp, self.path)
+        except BaseException:
+            os.remove(temp)
+            raise
+
+        self.version = self.get_version()
+
+    def lookup(self, names, register=False):
+        # Each distinct name is only looked up once: the codes of the names into the distinct ones and their IDs, -1 for
+        # unknown names unless register is on. The IDs end with an extra -1, which the code of a missing value (-1) picks
+        codes, uniques = pd.factorize(names if isinstance(names, pd.Series) else pd.Series(list(names), dtype=object))
+
+        with self.lock:
+            self.load()
+            ids = [self.ids.get(get_key(name), -1) for name in uniques]
+
+            if register and -1 in ids:
+                with self.locked():
+                    # Another process may have added some of them since
+                    self.load()
+                    count = len(self.names)
+                    ids = [self.add(name) for name in uniques]
+                    if len(self.names) != count:
+                        self.save()
+
+        return codes, uniques, np.append(np.array(ids, dtype="int32"), np.int32(-1))
+
+    def register(self, names):
+        # For ingest, adds the names that aren't known yet
+        self.lookup(names, register=True)
+
+    def get_ids(self, names, register=False):
+        # IDs of a list, array or Series of names. Unknown names are -1, as are missing values, unless register is on
+        codes, uniques, ids = self.lookup(names, register)
+        return ids[codes]
+
+    def get_names(self):
+        with self.lock:
+            self.load()
+            return list(self.names)
+
+    def canonical(self, name, register=False):
+        return self.canonicalize([name], register)[0]
+
+    def canonicalize(self, names, register=False):
+        # The canonical name of each name, a Series keeps its index. Names that aren't known are only normalised,
+        # unless register is on
+        codes, uniques, ids = self.lookup(names, register)
+
+        values = np.array(self.get_names() + [None], dtype=object)[ids]
+        values[:-1] = [value if value is not None else normalize(name) for value, name in zip(values[:-1], uniques)]
+        values = values[codes]
+
+        return pd.Series(values, index=names.index) if isinstance(names, pd.Series) else values
+
+    def categorical(self, names, register=False):
+        # Codes are the country IDs, unknown names are missing values unless register is on
+        ids = self.get_ids(names, register)
+        return pd.Categorical.from_codes(ids, categories=pd.Index(self.get_names(), dtype=object))
+
+    def isin(self, names, countries, register=False):
+        # Boolean mask of the names that are one of countries, compared by ID. Without register, unknown names on
+        # either side match nothing, so ingest registers them first
+        ids = self.get_ids(countries, register)
+        return np.isin(self.get_ids(names, register), ids[ids >= 0])
+
+
+registry = Countries()
@@ -1,19 +1,234 @@
-from flask import Flask, render_template
+from flask import Flask, Response, abort, make_response, render_template, request
 from flask_nav import Nav
 from flask_nav.elements import Navbar, View
 from flask_bootstrap import Bootstrap
+from collections import OrderedDict
+import functools
+import gzip
+import os
+import threading
+import time
 
-from Graphs import Graphs
-import pandas as pd
+from datetime import datetime
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from Aggregates import Aggregates
+from Countries import registry
+import Downsample
+from Graphs import FigureCache, Graphs
+from Metrics import Metrics, metrics
+from Scheduler import Scheduler
+from Store import Store
 
 app = Flask(__name__)
 Bootstrap(app)
 
 graphs = Graphs()
+aggregates = Aggregates()
+# Apart from the figures, the aggregates have a version of their own
+aggregate_json = FigureCache()
 nav = Nav()
 
 nav.init_app(app)
-print(pd.read_pickle("./data-frames/cleansed-data/UK.pkl").tail(1))
+
+# Responses worth compressing, smaller ones aren't worth the time
+compressible = {"text/html", "text/plain", "application/json"}
+minimum_size = 1024
+encodings = ["br", "gzip"] if brotli is not None else ["gzip"]
+
+# Compressed bodies by (path, etag, encoding), the same figure is compressed once and not on every request. The
+# path is part of the key as a page and the API can send the same figure under the same ETag
+compressed = OrderedDict()
+compressed_lock = threading.Lock()
+
+# Every figure a page shows, by the name the template expects it under
+pages = {
+    "home": {"pie": ("pi", "", ["active_cases", "deaths", "total_recovered"], ["UK"], {})},
+    "uk": {"scatter": ("scatter", "Cases UK", ["cases", "active_cases", "deaths", "total_recovered"], ["UK"],
+                       {"y_label": "Poeple Affected", "start_date": "2020-03-01"}),
+           "pie": ("pi", "", ["active_cases", "deaths", "total_recovered"], ["UK"], {})},
+}
+
+
+def get_figures(page):
+    figures = {}
+    for name, (chart, title, labels, countries, kwargs) in pages[page].items():
+        figures[name] = graphs.get_figure_json(chart, title, labels, countries, **kwargs)
+
+    return figures
+
+
+def precompute():
+    # Called at startup and once the data has been refreshed so the first visitor doesn't pay for building the figures
+    for page in pages:
+        try:
+            get_figures(page)
+        except Exception as e:
+            print("Could not precompute figures for %s: %s" % (page, e))
+
+
+def conditional_response(entries, render):
+    etag = "-".join(entry["etag"] for entry in entries)
+    last_modified = max(entry["last_modified"] for entry in entries)
+
+    # Weak, a gzip and a brotli response of the same figure aren't byte for byte the same
+    if request.if_none_match.contains_weak(etag) or (
+            not request.if_none_match and request.if_modified_since is not None and
+            request.if_modified_since.replace(tzinfo=None) >= last_modified.replace(microsecond=0)):
+        response = Response(status=304)
+    else:
+        response = make_response(render())
+
+    response.set_etag(etag, weak=True)
+    response.last_modified = last_modified
+    return response
+
+
+def render_page(template, page):
+    figures = get_figures(page)
+
+    return conditional_response([figures[name] for name in sorted(figures)],
+                                lambda: render_template(template, **{name: figure["json"]
+                                                                     for name, figure in figures.items()}))
+
+
+def get_list(name, default=None):
+    # Accepts both ?countries=UK,Italy and ?countries=UK&countries=Italy
+    values = [value for arg in request.args.getlist(name) for value in arg.split(",") if value]
+    if not values and default is None:
+        abort(400, "'%s' is required" % name)
+
+    return values or default
+
+
+def get_countries():
+    # Any spelling of a country, "United Kingdom" or "united_kingdom" for UK. A country there is no data for is a 404,
+    # nothing is read for it
+    countries = list(registry.canonicalize(get_list("countries"), register=False))
+    known = graphs.get_known()
+    unknown = [country for country in countries if country not in known]
+    if unknown:
+        abort(404, "Unknown countries: %s" % ", ".join(unknown))
+
+    return countries
+
+
+def get_date(name):
+    date = request.args.get(name)
+    if date is not None:
+        try:
+            datetime.strptime(date, "%Y-%m-%d")
+        except ValueError:
+            abort(400, "'%s' must be a YYYY-MM-DD date" % name)
+
+    return date
+
+
+def get_downsampling():
+    # ?points=500&downsample=lttb|minmax, a point budget per trace
+    kwargs = {}
+    if request.args.get("points") is not None:
+        try:
+            kwargs["points"] = int(request.args["points"])
+        except ValueError:
+            abort(400, "'points' must be a whole number")
+        if kwargs["points"] < 4:
+            abort(400, "'points' must be at least 4")
+
+    if request.args.get("downsample") is not None:
+        if request.args["downsample"] not in Downsample.methods:
+            abort(400, "'downsample' must be one of %s" % ", ".join(Downsample.methods))
+        kwargs["downsample"] = request.args["downsample"]
+
+    return kwargs
+
+
+def get_labels():
+    labels = get_list("labels", ["cases", "active_cases", "deaths", "total_recovered"])
+    unknown = [label for label in labels if label not in Store.columns]
+    if unknown:
+        abort(400, "Unknown labels: %s" % ", ".join(unknown))
+
+    return labels
+
+
+def json_response(entry):
+    return conditional_response([entry], lambda: Response(entry["json"], mimetype="application/json"))
+
+
+def record_requests(wsgi_app):
+    # Around the whole WSGI app rather than in after_request, which is skipped when an exception propagates (debug
+    # mode) or another hook fails, so every request is counted, 500s included
+    @functools.wraps(wsgi_app)
+    def wrapper(environ, start_response):
+        start = time.perf_counter()
+        statuses = []
+
+        def record_status(status, headers, exc_info=None):
+            statuses.append(int(status.split(" ", 1)[0]))
+            return start_response(status, headers, exc_info)
+
+        try:
+            return wsgi_app(environ, record_status)
+        finally:
+            endpoint = environ.get("covid.endpoint", "unmatched")
+            metrics.inc("covid_http_requests_total", endpoint=endpoint, status=statuses[-1] if statuses else 500)
+            metrics.observe("covid_http_request_seconds", time.perf_counter() - start, endpoint=endpoint)
+
+    return wrapper
+
+
+app.wsgi_app = record_requests(app.wsgi_app)
+
+
+@app.before_request
+def set_endpoint():
+    # Labelled by route rather than path, so /api/series?countries=... is one series however it is queried
+    if request.url_rule is not None:
+        request.environ["covid.endpoint"] = request.url_rule.rule
+
+
+def compress_body(data, encoding):
+    if encoding == "br":
+        return brotli.compress(data, quality=5)
+
+    return gzip.compress(data, compresslevel=6)
+
+
+@app.after_request
+def compress(response):
+    # The time spent compressing is part of the request's, see record_requests
+    if response.status_code != 200 or response.direct_passthrough or response.is_streamed or \
+            response.mimetype not in compressible or "Content-Encoding" in response.headers:
+        return response
+
+    response.vary.add("Accept-Encoding")
+    encoding = request.accept_encodings.best_match(encodings)
+    data = response.get_data()
+    if encoding is None or len(data) < minimum_size:
+        return response
+
+    etag = response.get_etag()[0]
+    key = (request.path, etag, encoding)
+    with compressed_lock:
+        body = compressed.get(key) if etag is not None else None
+
+    if body is None:
+        body = compress_body(data, encoding)
+        if etag is not None:
+            with compressed_lock:
+                compressed[key] = body
+                while len(compressed) > 256:
+                    compressed.popitem(last=False)
+
+    metrics.inc("covid_http_compression_saved_bytes_total", len(data) - len(body), encoding=encoding)
+    response.set_data(body)
+    response.headers["Content-Encoding"] = encoding
+    return response
 
 
 @nav.navigation()
@@ -27,32 +242,111 @@ def navbar():
 @app.route("/")
 def home():
 
-    pie = graphs.pi("", ["active_cases", "deaths", "total_recovered"], ["UK"])
-    pie = graphs.get_json(pie)
-
-    return render_template("home.html", pie=pie)
+    return render_page("home.html", "home")
 
 
 @app.route("/UK")
 def uk():
 
-    date = "2020-03-01"
-    days = 7 + 4
-    country_to_view = ["UK"]
+    return render_page("uk.html", "uk")
+
+
+@app.route("/api/series")
+def api_series():
+
+    return json_response(graphs.get_data_json("series", get_labels(), get_countries(),
+                                              start_date=get_date("start_date"), end_date=get_date("end_date"),
+                                              **get_downsampling()))
+
+
+@app.route("/api/values")
+def api_values():
+
+    return json_response(graphs.get_data_json("values", get_labels(), get_countries(), date=get_date("date")))
+
+
+@app.route("/api/chart/<chart>")
+def api_chart(chart):
+    if chart == "pi":
+        kwargs = {"date": get_date("date")}
+    elif chart in ("scatter", "bar"):
+        kwargs = dict(get_downsampling(), start_date=get_date("start_date"), y_label=request.args.get("y_label"))
+        if chart == "scatter":
+            kwargs["end_date"] = get_date("end_date")
+    else:
+        abort(404)
+
+    return json_response(graphs.get_figure_json(chart, request.args.get("title", ""), get_labels(),
+                                                get_countries(), **kwargs))
+
+
+def get_aggregate_json(key, get):
+    # Cached like the figures, against the time the aggregates were last materialised
+    def build():
+        df = get()
+        if df is None:
+            abort(404)
+        if df.index.name == "date":
+            df = df.reset_index()
+        return df.to_json(orient="records", date_format="iso", date_unit="s", double_precision=2)
+
+    return aggregate_json.get(key, aggregates.mtime(), build)
+
+
+@app.route("/api/aggregates/<scope>")
+def api_aggregates(scope):
+    name = request.args.get("name", "")
+    start_date = get_date("start_date")
+    end_date = get_date("end_date")
+
+    return json_response(get_aggregate_json(("aggregates", scope, name, start_date, end_date),
+                                            lambda: aggregates.get_rollup(scope, name, start_date, end_date)))
+
+
+@app.route("/api/top")
+def api_top():
+    date = get_date("date")
+
+    return json_response(get_aggregate_json(("top", date), lambda: aggregates.get_top(date)))
+
+
+@app.route("/metrics")
+def prometheus():
+    for name, cache in (("frame", graphs.cache), ("figure", graphs.figures), ("aggregate", aggregate_json)):
+        for key, value in cache.stats().items():
+            metrics.set("covid_%s_cache_%s" % (name, key), value)
+
+    # A refresher in its own process (python Scheduler.py) leaves its refresh and fetch metrics in a file
+    if refresh_in_app:
+        return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+    merged = metrics.merge(Metrics.load(Scheduler.metrics_path), process="refresher")
+    return Response(merged.render(), mimetype="text/plain; version=0.0.4")
+
 
+# Off the import path so a new worker can take requests straight away, any page asked for before this is done just
+# builds its own figures. PRECOMPUTE=0 skips it, e.g. for short lived workers.
+if os.environ.get("PRECOMPUTE", "1") == "1":
+    threading.Thread(target=precompute, name="precompute", daemon=True).start()
 
-    g = [["cases", "active_cases", "deaths", "total_recovered"],
-         ["deaths/cases%", "recovered/cases%", "active/cases%"]]
-    scatter = graphs.scatter("Cases %s" % country_to_view[0], g[0], country_to_view, y_label="Poeple Affected",
-                             start_date=date)
-    scatter = graphs.get_json(scatter)
+# Set RAPIDAPI_KEY to have the app keep its own data up to date in the background
+scheduler = Scheduler(key=os.environ.get("RAPIDAPI_KEY"), interval=int(os.environ.get("REFRESH_INTERVAL", 600)))
 
-    pie = graphs.pi("", ["active_cases", "deaths", "total_recovered"], ["UK"])
-    pie = graphs.get_json(pie)
 
+@scheduler.add_listener
+def refreshed():
+    graphs.cache.clear()
+    graphs.figures.clear()
+    aggregate_json.clear()
+    with compressed_lock:
+        compressed.clear()
+    precompute()
 
-    return render_template("uk.html", pie=pie)
 
+# wsgi.py turns this off, with several workers the refresh runs once in its own process instead (python Scheduler.py)
+refresh_in_app = scheduler.key is not None and os.environ.get("REFRESH_IN_APP", "1") == "1"
+if refresh_in_app:
+    scheduler.start()
 
 if __name__ == "__main__":
 
@@ -1,8 +1,27 @@
 import http.client
 import ast
+import json
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 import os.path
+import hashlib
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+from urllib.parse import quote
+
+from Aggregates import Aggregates
+from Arrays import Arrays
+from Countries import normalize, registry
+from Metrics import metrics
+from Snapshots import Snapshots
+from Store import Store
+from Writer import Writer
 
 """
 This class is designed to pull data from https://rapidapi.com/astsiatsko/api/coronavirus-monitor.
@@ -28,8 +47,44 @@ class Data:
     pd.set_option('display.max_columns', 500)
     pd.set_option('display.width', 1000)
 
-    def __init__(self, key=None, getWorldHistoryData=False):
-        self.conn = http.client.HTTPSConnection("coronavirus-monitor.p.rapidapi.com")
+    history_columns = ["active_cases", "country_name", "id", "new_cases", "new_deaths", "record_date", "region",
+                       "serious_critical", "total_cases", "total_cases_per1m", "total_deaths", "total_recovered"]
+
+    # Numeric columns returned by each endpoint and the dtype they are stored as once cleaned
+    schemas = {
+        "history": {"active_cases": "Int32", "id": "Int32", "new_cases": "Int32", "new_deaths": "Int32",
+                    "serious_critical": "Int32", "total_cases": "Int32", "total_cases_per1m": "float32",
+                    "total_deaths": "Int32", "total_recovered": "Int32"},
+        "cases_by_country": {"cases": "Int32", "deaths": "Int32", "total_recovered": "Int32", "new_deaths": "Int32",
+                             "new_cases": "Int32", "serious_critical": "Int32", "active_cases": "Int32",
+                             "total_cases_per_1m_population": "float32"},
+        "world_stats": {"total_cases": "Int32", "total_deaths": "Int32", "total_recovered": "Int32",
+                        "new_cases": "Int32", "new_deaths": "Int32"},
+    }
+
+    # Derived percentage columns as name: (numerator, denominator)
+    ratios = {
+        "history": {"total deaths/cases%": ("total_deaths", "total_cases"),
+                    "total recovered/cases%": ("total_recovered", "total_cases")},
+        "cases_by_country": {"deaths/cases%": ("deaths", "cases"),
+                             "recovered/cases%": ("total_recovered", "cases"),
+                             "active/cases%": ("active_cases", "cases")},
+        "world_stats": {"deaths/cases%": ("total_deaths", "total_cases"),
+                        "recovered/cases%": ("total_recovered", "total_cases")},
+    }
+
+    fetch_state_path = "./data-frames/fetch-state.json"
+
+    def __init__(self, key=None, getWorldHistoryData=False, host="coronavirus-monitor.p.rapidapi.com", secure=True,
+                 workers=8, retries=5, backoff=0.5):
+        self.host = host
+        self.secure = secure
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+
+        # One keep-alive connection per worker thread, reused for every request that thread makes
+        self.connections = threading.local()
 
         self.headers = {
             'x-rapidapi-host': "coronavirus-monitor.p.rapidapi.com",
@@ -38,171 +93,223 @@ class Data:
 
         self.date = datetime.today().strftime("%Y-%m-%d")
         self.affected_countries = None
-
-        self.update_affected_countries()
-
-        if getWorldHistoryData:
-            self.update_history_by_affected_country()
-        else:
-            self.update_country_history()
-
-        self.update_cases_by_country()
-        self.update_world_stats()
-        self.update_cleansed_data()
-
+        self.coerced = {}
+        self.store = Store()
+        self.aggregates = Aggregates()
+        self.arrays = Arrays()
+        self.snapshots = Snapshots()
+        self.writer = Writer()
+
+        # ETag, Last-Modified, content hash and statistic_taken_at of the last response seen from each url
+        self.fetch_state = {}
+        self.fetched = {}
+        self.fetch_lock = threading.Lock()
+        if os.path.isfile(self.fetch_state_path):
+            with open(self.fetch_state_path) as file:
+                self.fetch_state = json.load(file)
+
+        self.cases_changed = True
+
+        try:
+            self.update_affected_countries()
+
+            # The histories and the two snapshots only need the affected countries, so they are fetched side by side
+            # while the writer saves whatever has already been parsed
+            with ThreadPoolExecutor(max_workers=3) as pool:
+                updates = [pool.submit(self.update_history_by_affected_country if getWorldHistoryData else
+                                       self.update_country_history),
+                           pool.submit(self.update_cases_by_country),
+                           pool.submit(self.update_world_stats)]
+                for update in updates:
+                    update.result()
+
+            # Everything from here on reads the pickles back
+            self.writer.wait()
+            self.update_snapshots()
+            self.update_cleansed_data()
+            self.update_aggregates()
+            self.update_arrays()
+
+            self.save_fetch_state()
+            if self.writer.written:
+                self.writer.mark_version()
+        finally:
+            self.writer.close()
+
+    @metrics.timed("update_cleansed_data")
     def update_cleansed_data(self):
-        # print(self.affected_countries)
+        if not self.cases_changed and self.store.exists():
+            print("Unchanged 'cleansed data'")
+            return
 
-        for country in self.affected_countries["affected_countries"]:
+        if not self.store.exists() and os.path.isdir("./data-frames/cleansed-data/"):
+            self.store.import_pickles("./data-frames/cleansed-data/")
 
-            path = "./data-frames/cleansed-data/%s.pkl" % country
-            today = str(datetime.today()).split(" ")[0]
-            try:
-                df = pd.read_pickle(path)
+        # Read today's snapshot once and upsert every affected country's row into the partition of the day it was
+        # taken on, which isn't always today's
+        df = pd.read_pickle("./data-frames/cases-by-country/cases-by-country_%s.pkl" % self.date)
+        df = df.loc[registry.isin(df["country_name"], self.affected_countries["affected_countries"], register=True)]
+        df = self.add_ratios(df, "cases_by_country")
 
-                last = df.tail(1)
-                if today in str(last["statistic_taken_at"]):
-                    df = df.head(len(df['cases']) - 1)
-                    print("Updating 'cleansed data' data-frame %s" % country)
+        days = self.store.upsert(df)
+        print("Updated 'cleansed data' partitions %s" % ", ".join(days))
 
-                else:
-                    print("Adding to 'cleansed data' data frame %s" % country)
+    @metrics.timed("update_snapshots")
+    def update_snapshots(self):
+        if not self.snapshots.compact():
+            print("Unchanged 'snapshots' catalog")
 
-            except Exception as e:
-                print(e)
+    @metrics.timed("update_aggregates")
+    def update_aggregates(self):
+        if self.aggregates.mtime() >= self.store.mtime():
+            print("Unchanged 'aggregates'")
+            return
 
-                df = pd.DataFrame()
+        self.aggregates.materialize(self.store.read(), lambda df: self.add_ratios(df, "cases_by_country"))
 
-            to_append = pd.read_pickle("./data-frames/cases-by-country/cases-by-country_%s.pkl" % today)
-            to_append = to_append.loc[to_append['country_name'] == country]
+    @metrics.timed("update_arrays")
+    def update_arrays(self):
+        if self.arrays.mtime() >= self.store.mtime():
+            print("Unchanged 'arrays' export")
+            return
 
-            df = df.append(to_append)
-            df["active/cases%"] = round(df["active_cases"] / df["cases"] * 100, 2)
-            df["deaths/cases%"] = round(df["deaths"] / df["cases"] * 100, 2)
-            df["recovered/cases%"] = round(df["total_recovered"] / df["cases"] * 100, 2)
-            df = df.drop(["country_name", "region"], axis=1)
-
-            df = df.reset_index(drop=True)
-
-            df.to_pickle(path)
+        self.arrays.export(self.store.read())
 
+    @metrics.timed("update_affected_countries")
     def update_affected_countries(self):
 
-        self.affected_countries = self.get_affected_countries()
-
         path = "./data-frames/countries-affected/countries-affected_%s.pkl" % self.date
-        df = self.get_affected_countries()
+        df = self.get_affected_countries(conditional=os.path.isfile(path))
+
+        if df is None:
+            print("Unchanged 'affected countries' data frame %s" % self.date)
+            self.affected_countries = pd.read_pickle(path)
+            return
+
+        self.affected_countries = df
 
         if os.path.isfile(path):
             print("Updating 'affected countries' data frame %s" % self.date)
-            df.to_pickle(path)
+            self.save(df, path)
         else:
             print("Creating 'affected countries' data frame %s" % self.date)
-            df.to_pickle(path)
+            self.save(df, path)
 
-    def update_history_by_affected_country(self):
+    @metrics.timed("update_history_by_affected_country")
+    def update_history_by_affected_country(self, workers=None):
+        workers = workers or self.workers
 
-        for country in self.affected_countries["affected_countries"]:
-            path = "./data-frames/countries-affected-history/%s.pkl" % country
-            df = self.get_history_by_affected_country(country)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(self.update_country_history, country): country
+                       for country in self.affected_countries["affected_countries"]}
 
-            if os.path.isfile(path):
-                print("Updating 'history by affected country' data frame %s" % country)
-                df.to_pickle(path)
-            else:
-                df.to_pickle(path)
-                print("Creating 'history by affected country' data frame %s" % country)
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    print("Failed 'history by affected country' data frame %s: %s" % (futures[future], e))
 
+    @metrics.timed("update_country_history", "country")
     def update_country_history(self, country="UK"):
 
         path = "./data-frames/countries-affected-history/%s.pkl" % country
-        df = self.get_history_by_affected_country("UK")
+        df = self.get_history_by_affected_country(country, conditional=os.path.isfile(path))
 
-        if os.path.isfile(path):
+        if df is None:
+            print("Unchanged 'history by affected country' data frame %s" % country)
+        elif os.path.isfile(path):
             print("Updating 'history by affected country' data frame %s" % country)
-            df.to_pickle(path)
+            self.save(df, path)
         else:
-            df.to_pickle(path)
+            self.save(df, path)
             print("Creating 'history by affected country' data frame %s" % country)
 
+    @metrics.timed("update_cases_by_country")
     def update_cases_by_country(self):
 
         path = "./data-frames/cases-by-country/cases-by-country_%s.pkl" % self.date
-        df = self.get_cases_by_country()
+        df = self.get_cases_by_country(conditional=os.path.isfile(path))
+        self.cases_changed = df is not None
 
-        if os.path.isfile(path):
+        if df is None:
+            print("Unchanged 'cases by country' data frame %s" % self.date)
+        elif os.path.isfile(path):
             print("Updating 'cases by country' data frame  %s" % self.date)
-            df.to_pickle(path)
+            self.save(df, path)
         else:
-            df.to_pickle(path)
+            self.save(df, path)
             print("Creating 'cases by country' data frame %s" % self.date)
 
+    @metrics.timed("update_world_stats")
     def update_world_stats(self):
 
         path = "./data-frames/global-data/world-stats_%s.pkl" % self.date
-        df = self.get_world_total_stats()
+        df = self.get_world_total_stats(conditional=os.path.isfile(path))
 
-        if os.path.isfile(path):
+        if df is None:
+            print("Unchanged 'world stats' data frame %s" % self.date)
+        elif os.path.isfile(path):
             print("Updating 'world stats' data frame %s" % self.date)
-            df.to_pickle(path)
+            self.save(df, path)
         else:
-            df.to_pickle(path)
+            self.save(df, path)
             print("Creating 'world stats' data frame %s" % self.date)
 
-    def get_affected_countries(self):
-        self.conn.request("GET", "/coronavirus/affected.php", headers=self.headers)
-
-        res = self.conn.getresponse()
-        data = res.read()
+    @metrics.timed("get_affected_countries")
+    def get_affected_countries(self, conditional=False):
+        url = "/coronavirus/affected.php"
+        data = self.request(url, conditional)
+        if data is None:
+            return None
 
         df = pd.DataFrame(ast.literal_eval(data.decode("utf-8")))
+        metrics.inc("covid_parsed_rows_total", len(df), endpoint="affected")
+        self.commit_fetch(url)
 
         return df
 
-    def get_history_by_affected_country(self, country):
-        if "ç" in country or "é" in country:
-            url = "/coronavirus/cases_by_particular_country.php?country=R%25C3%25A9union"
-            return pd.DataFrame({country: ["ENCODEING ERROR"]})  # ENCODING BUG BYPASSING FOR NOW
-        else:
-            url = "/coronavirus/cases_by_particular_country.php?country=%s" % country.replace(" ", "%20")
-
-        self.conn.request("GET", url, headers=self.headers)
-
-        res = self.conn.getresponse()
-        data = res.read().decode("utf-8")
-        data = data.replace('{"country":"%s","stat_by_country":[' % country, "").replace("]", "").replace("null",
-                                                                                                          '"null"').split(
-            "},")
-        df = pd.DataFrame()
-
-        for i in range(len(data)):
-            if country in data[i]:
-                if i != len(data) - 1:
-                    df = df.append(ast.literal_eval(data[i] + "}"), ignore_index=True)
-                else:
-                    df = df.append(ast.literal_eval(data[i][:-1]), ignore_index=True)
-
-        df["active_cases"] = self.steralize(df["active_cases"], int)
-        df["id"] = self.steralize(df["id"], int)
-        df["new_cases"] = self.steralize(df["new_cases"], int)
-        df["new_deaths"] = self.steralize(df["new_deaths"], int)
-        df["serious_critical"] = self.steralize(df["serious_critical"], int)
-        df["total_cases"] = self.steralize(df["total_cases"], int)
-        df["total_cases_per1m"] = self.steralize(df["total_cases_per1m"], float)
-        df["total_deaths"] = self.steralize(df["total_deaths"], int)
-        df["total_recovered"] = self.steralize(df["total_recovered"], int)
-
-        df["total deaths/cases%"] = df["total_deaths"] / df["total_cases"] * 100
-        df["total recovered/cases%"] = df["total_recovered"] / df["total_cases"] * 100
-        df = df.round({"total deaths/cases%": 2, "total recovered/cases%": 2})
+    @metrics.timed("get_history_by_affected_country", "country")
+    def get_history_by_affected_country(self, country, conditional=False):
+        # Percent-encode the UTF-8 name so countries like Réunion and Curaçao can be requested
+        # Composed, so Réunion is asked for the same way however the name was spelled where it came from
+        url = "/coronavirus/cases_by_particular_country.php?country=%s" % quote(normalize(country))
+        data = self.request(url, conditional)
+        if data is None:
+            return None
+
+        df = self.parse_history(data)
+        metrics.inc("covid_parsed_rows_total", len(df), endpoint="history")
+        self.commit_fetch(url)
+
+        return df
+
+    def parse_history(self, data):
+        records = json.loads(data)["stat_by_country"] or []
+
+        # Build each column as a plain list in a single pass and create the data frame once at the end
+        keys = list(records[0].keys()) if records else self.history_columns
+        columns = {key: [] for key in keys}
+        appends = [(key, columns[key].append) for key in keys]
+
+        for record in records:
+            for key, append in appends:
+                append(record.get(key))
+
+        df = pd.DataFrame(columns, columns=keys, dtype=object)
+
+        df = self.sanitize(df, "history")
+        df = self.add_ratios(df, "history")
 
         return df
 
-    def get_cases_by_country(self):
-        self.conn.request("GET", "/coronavirus/cases_by_country.php", headers=self.headers)
+    @metrics.timed("get_cases_by_country")
+    def get_cases_by_country(self, conditional=False):
+        url = "/coronavirus/cases_by_country.php"
+        data = self.request(url, conditional)
+        if data is None:
+            return None
 
-        res = self.conn.getresponse()
-        data = res.read().decode("utf-8")
+        data = data.decode("utf-8")
 
         data = ast.literal_eval(data)
 
@@ -210,30 +317,23 @@ class Data:
 
         print(df)
 
-        df["cases"] = self.steralize(df["cases"], int)
-        df["deaths"] = self.steralize(df["deaths"], int)
-        df["total_recovered"] = self.steralize(df["total_recovered"], int)
-        df["new_cases"] = self.steralize(df["new_cases"], int)
-        df["serious_critical"] = self.steralize(df["serious_critical"], int)
-        df["active_cases"] = self.steralize(df["active_cases"], int)
-        df["total_cases_per_1m_population"] = self.steralize(df["total_cases_per_1m_population"], float)
-
-        df["deaths/cases%"] = df["deaths"] / df["cases"] * 100
-        df["recovered/cases%"] = df["total_recovered"] / df["cases"] * 100
-        df["active/cases%"] = df["active_cases"] / df["cases"] * 100
-
-        df = df.round({"deaths/cases%": 2, "recovered/cases%": 2, "active/cases%": 2})
+        df = self.sanitize(df, "cases_by_country")
+        df = self.add_ratios(df, "cases_by_country")
 
         df["statistic_taken_at"] = data["statistic_taken_at"]
+        metrics.inc("covid_parsed_rows_total", len(df), endpoint="cases_by_country")
+        self.commit_fetch(url)
 
         return df
 
-    def get_world_total_stats(self):
-        self.conn.request("GET", "/coronavirus/worldstat.php", headers=self.headers)
+    @metrics.timed("get_world_total_stats")
+    def get_world_total_stats(self, conditional=False):
+        url = "/coronavirus/worldstat.php"
+        data = self.request(url, conditional)
+        if data is None:
+            return None
 
-        res = self.conn.getresponse()
-        data = res.read().decode("utf-8")
-        data = ast.literal_eval(data)
+        data = ast.literal_eval(data.decode("utf-8"))
 
         data_to_save = {}
 
@@ -245,62 +345,221 @@ class Data:
 
         df = pd.DataFrame(data_to_save)
 
-        df['total_cases'] = self.steralize(df['total_cases'], int)
-        df['total_deaths'] = self.steralize(df['total_deaths'], int)
-        df['total_recovered'] = self.steralize(df['total_recovered'], int)
-        df['new_cases'] = self.steralize(df['new_cases'], int)
-        df['new_deaths'] = self.steralize(df['new_deaths'], int)
-
-        df["deaths/cases%"] = df["total_deaths"] / df["total_cases"] * 100
-        df["recovered/cases%"] = df["total_recovered"] / df["total_cases"] * 100
-        df = df.round({"deaths/cases%": 2, "recovered/cases%": 2})
+        df = self.sanitize(df, "world_stats")
+        df = self.add_ratios(df, "world_stats")
+        metrics.inc("covid_parsed_rows_total", len(df), endpoint="world_stats")
+        self.commit_fetch(url)
 
         return df
 
-    def get_pre_api_data(self):
+    @metrics.timed("get_pre_api_data")
+    def get_pre_api_data(self, workers=8):
 
-        df = pd.read_csv("./data-frames/COVID-19-geographic-disbtribution-worldwide-2020-03-18.csv")
+        df = pd.read_csv("./data-frames/COVID-19-geographic-disbtribution-worldwide-2020-03-18 .csv")
+        df["DateRep"] = pd.to_datetime(df["DateRep"])  # - np.timedelta64(1, 'D')
 
-        for country in df["Countries and territories"].drop_duplicates():
-            data = df[df["Countries and territories"] == country.replace(" ", "_")]
-            data["DateRep"] = pd.to_datetime(data["DateRep"])  # - np.timedelta64(1, 'D')
-            data = data.iloc[::-1]
+        # The csv lists each country newest first, reversing the whole frame puts every country oldest first
+        df = df.iloc[::-1]
+        countries = df.groupby("Countries and territories", sort=False)
+        df["total_cases"] = countries["Cases"].cumsum()
+        df["total_death"] = countries["Deaths"].cumsum()
 
-            data["total_cases"] = data["Cases"].cumsum()
-            data["total_death"] = data["Deaths"].cumsum()
+        # Files are named by the canonical name, the one the rest of the data uses
+        df["Countries and territories"] = registry.canonicalize(df["Countries and territories"], register=True)
 
+        def write(item):
+            country, data = item
             print("Creating 'pre-api' data set %s " % country)
             data.to_pickle("./data-frames/pre-api/%s.pkl" % country)
 
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(write, df.groupby("Countries and territories", sort=False)))
+
     def determine_irregularities(self):
-        df = pd.read_csv("./data-frames/COVID-19-geographic-disbtribution-worldwide-2020-03-18.csv")
+        df = pd.read_csv("./data-frames/COVID-19-geographic-disbtribution-worldwide-2020-03-18 .csv")
 
         df2 = pd.read_pickle("./data-frames/countries-affected/countries-affected_2020-03-19.pkl")
-        i = 0
-        for country in df["Countries and territories"].drop_duplicates():
-            if country not in list(df2["affected_countries"]):
-                print(i, country)
-            i += 1
 
-    def steralize(self, column, type):
+        # Countries in the csv the API didn't list, matched by ID so spellings and aliases aren't reported
+        countries = df["Countries and territories"].drop_duplicates()
+        missing = ~registry.isin(countries, df2["affected_countries"])
+        for i, country in zip(np.flatnonzero(missing), countries[missing]):
+            print(i, country)
+
+    def save(self, df, path):
+        # Written in the background, see Writer. Returns the future of the write
+        return self.writer.submit(df, path)
+
+    def get_connection(self):
+        conn = getattr(self.connections, "conn", None)
+
+        if conn is None:
+            if self.secure:
+                conn = http.client.HTTPSConnection(self.host, timeout=30)
+            else:
+                conn = http.client.HTTPConnection(self.host, timeout=30)
+            self.connections.conn = conn
+
+        return conn
+
+    def get_backoff(self, attempt):
+        return self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+
+    def request(self, url, conditional=False):
+        # With conditional set, None is returned when the server or the content says nothing changed since last time
+        previous = self.fetch_state.get(url, {}) if conditional else {}
+        headers = dict(self.headers)
+        if previous.get("etag"):
+            headers["If-None-Match"] = previous["etag"]
+        if previous.get("last_modified"):
+            headers["If-Modified-Since"] = previous["last_modified"]
+
+        for attempt in range(self.retries + 1):
+            conn = self.get_connection()
+            try:
+                conn.request("GET", url, headers=headers)
+                res = conn.getresponse()
+                data = res.read()
+            except (http.client.HTTPException, OSError):
+                # The server dropped the keep-alive connection, open a fresh one on the next attempt
+                metrics.inc("covid_api_requests_total", status="error")
+                conn.close()
+                self.connections.conn = None
+                if attempt == self.retries:
+                    raise
+                time.sleep(self.get_backoff(attempt))
+                continue
+
+            metrics.inc("covid_api_requests_total", status=res.status)
+            metrics.inc("covid_fetched_bytes_total", len(data), endpoint=url.split("?")[0])
+
+            if res.status == 429 or res.status >= 500:
+                if attempt == self.retries:
+                    raise http.client.HTTPException("%s returned %d after %d attempts" % (url, res.status, attempt + 1))
+
+                # Rate limited or overloaded, wait as long as the server asks or back off exponentially
+                try:
+                    delay = float(res.getheader("Retry-After"))
+                except (TypeError, ValueError):
+                    delay = self.get_backoff(attempt)
+                time.sleep(delay)
+                continue
+
+            if res.status == 304:
+                return None
+
+            if res.status >= 400:
+                # A bad key or an unknown country won't go away by asking again, and the body is an error, not data
+                raise http.client.HTTPException("%s returned %d: %s" % (url, res.status,
+                                                                        data[:200].decode("utf-8", "replace")))
+
+            state = {"etag": res.getheader("ETag"),
+                     "last_modified": res.getheader("Last-Modified"),
+                     "hash": hashlib.sha1(data).hexdigest(),
+                     "statistic_taken_at": self.get_statistic_taken_at(data)}
+            with self.fetch_lock:
+                self.fetched[url] = state
+
+            if previous and (state["hash"] == previous.get("hash") or (
+                    state["statistic_taken_at"] is not None and
+                    state["statistic_taken_at"] == previous.get("statistic_taken_at"))):
+                return None
+
+            return data
+
+    def get_statistic_taken_at(self, data):
+        match = re.search(rb'"statistic_taken_at"\s*:\s*"([^"]*)"', data)
+        return match.group(1).decode("utf-8") if match else None
+
+    def commit_fetch(self, url):
+        # Only remember a response once it has been parsed, so a failed run is fetched again in full next time
+        with self.fetch_lock:
+            if url in self.fetched:
+                self.fetch_state[url] = self.fetched.pop(url)
+
+    def save_fetch_state(self):
+        with self.fetch_lock:
+            temp = self.fetch_state_path + ".tmp"
+            with open(temp, "w") as file:
+                json.dump(self.fetch_state, file, indent=1, sort_keys=True)
+            os.replace(temp, self.fetch_state_path)
+
+    def sanitize(self, df, endpoint):
+        coerced = 0
+
+        # Each column goes from the API's "1,234" strings to its compact dtype in one parse, done by pyarrow on the
+        # column's own buffers. Anything that isn't a number ("", "N/A") becomes a missing value and is counted
+        for column, dtype in self.schemas[endpoint].items():
+            if column not in df:
+                continue
+
+            raw = df[column]
+            if pd.api.types.is_numeric_dtype(raw):
+                values = raw.to_numpy(dtype="float64", na_value=np.nan)
+            else:
+                try:
+                    strings = pa.array(raw, type=pa.string())
+                except (pa.ArrowTypeError, pa.ArrowInvalid):
+                    # Numbers mixed in with the strings, e.g. [12, "1,234"], are parsed from their text like the rest
+                    strings = pa.array(raw.astype(str), type=pa.string())
+                strings = pc.replace_substring(strings, ",", "")
+                try:
+                    values = strings.cast(pa.float64())
+                except pa.ArrowInvalid:
+                    try:
+                        # Blanks are how the API leaves a number out, the only thing most columns need besides the cast
+                        values = pc.if_else(pc.equal(strings, ""), None, strings).cast(pa.float64())
+                    except pa.ArrowInvalid:
+                        values = pa.array(pd.to_numeric(strings.to_pandas(), errors="coerce"), type=pa.float64())
+                    coerced += values.null_count - strings.null_count
+                values = values.to_numpy(zero_copy_only=False)
+
+            if dtype.startswith("Int"):
+                # Missing values are masked, what the cast makes of their NaNs doesn't matter
+                with np.errstate(invalid="ignore"):
+                    df[column] = pd.arrays.IntegerArray(np.round(values).astype(dtype.lower()), np.isnan(values))
+            else:
+                df[column] = values.astype(dtype)
 
-        return pd.to_numeric(column.str.replace(",", "").astype(type, errors='ignore'), errors="coerce")
+        # Counted here and logged with the rest of the refresh by run()
+        self.coerced[endpoint] = coerced
+        metrics.inc("covid_coerced_values_total", coerced, endpoint=endpoint)
 
+        return df
+
+    @classmethod
+    def add_ratios(cls, df, endpoint):
+        for name, (numerator, denominator) in cls.ratios[endpoint].items():
+            numerator = df[numerator].to_numpy(dtype="float64", na_value=np.nan)
+            denominator = df[denominator].to_numpy(dtype="float64", na_value=np.nan)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                df[name] = np.round(numerator / denominator * 100, 2).astype("float32")
+
+        return df
 
-def run(key=None, getWorldHistoryData=False):
-    import time
+
+def run(key=None, getWorldHistoryData=False, workers=8):
     start = time.time()
-    data = Data(key=key, getWorldHistoryData=getWorldHistoryData)
+    fetched = metrics.total("covid_fetched_bytes_total")
+    parsed = metrics.total("covid_parsed_rows_total")
+
+    try:
+        with metrics.span("run"):
+            data = Data(key=key, getWorldHistoryData=getWorldHistoryData, workers=workers)
+    except Exception as e:
+        metrics.log("run", seconds=round(time.time() - start, 3), error="%s: %s" % (type(e).__name__, e))
+        raise
+
     end = round(time.time() - start, 3)
-    message = "Updated data in %.2f seconds on %s" % (end, datetime.now().strftime("%d-%m-%Y %H:%M:%S"))
-    print(message)
-    with open("./data-frames/updates-log.txt", "a+") as file:
-        file.write(message + '\n')
+    print("Updated data in %.2f seconds on %s" % (end, datetime.now().strftime("%d-%m-%Y %H:%M:%S")))
+    metrics.inc("covid_runs_total")
+    metrics.log("run", seconds=end, fetched_bytes=metrics.total("covid_fetched_bytes_total") - fetched,
+                parsed_rows=metrics.total("covid_parsed_rows_total") - parsed, coerced=data.coerced)
 
     return data
 
 
-def cl():
+def cl(workers=8):
     df = pd.read_pickle("./data-frames/UK.pkl")
     df = df.reset_index(drop=True)
     df["statistic_taken_at"] = pd.to_datetime(df["statistic_taken_at"])
@@ -309,38 +568,44 @@ def cl():
     df = pd.read_csv("./data-frames/COVID-19-geographic-disbtribution-worldwide-2020-03-18 .csv")
 
     df = df.drop(["Day", "Month", "Year", "GeoId"], axis=1)
-    df = df.rename(columns={"Cases": "new_cases", "Deaths": "new_deaths", "DateRep": "statistic_taken_at"})
+    df = df.rename(columns={"Cases": "new_cases", "Deaths": "new_deaths", "DateRep": "statistic_taken_at",
+                            "Countries and territories": "country_name"})
+    df["statistic_taken_at"] = pd.to_datetime(df["statistic_taken_at"]) - pd.offsets.Day(1)
+    df["country_name"] = registry.canonicalize(df["country_name"], register=True)
 
-    dates = ["2020-03-18", "2020-03-19", "2020-03-20"]
-    for country in df["Countries and territories"].drop_duplicates():
-        data = df.loc[df["Countries and territories"] == country]
-        data = data.iloc[::-1]
-        data["cases"] = data["new_cases"].cumsum()
-        data["deaths"] = data["new_deaths"].cumsum()
-
-        data["statistic_taken_at"] = pd.to_datetime(data["statistic_taken_at"]) - pd.offsets.Day(1)
-        data = data.drop(["Countries and territories"], axis=1)
+    # Every country oldest first, then running totals for all of them at once
+    df = df.iloc[::-1]
+    countries = df.groupby("country_name", sort=False)
+    df["cases"] = countries["new_cases"].cumsum()
+    df["deaths"] = countries["new_deaths"].cumsum()
 
-        for date in dates:
-            to_append = pd.read_pickle("./data-frames/cases-by-country/cases-by-country_%s.pkl" % date)
-            data = data.append(to_append.loc[to_append["country_name"] == country])
+    dates = ["2020-03-18", "2020-03-19", "2020-03-20"]
+    snapshots = [pd.read_pickle("./data-frames/cases-by-country/cases-by-country_%s.pkl" % date) for date in dates]
+    snapshots = [snapshot.loc[registry.isin(snapshot["country_name"], list(countries.groups), register=True)]
+                 for snapshot in snapshots]
 
-        data = data.drop(["country_name", "region"], axis=1)
+    # A stable sort on country keeps each country's csv rows ahead of its snapshot rows, in date order
+    data = pd.concat([df] + snapshots, sort=False).sort_values("country_name", kind="mergesort")
 
-        if country == "UK":
-            data = data.head(63).append(dx.tail(81 - 63))
-            data = data.append(to_append.loc[to_append["country_name"] == country])
+    uk = data.loc[data["country_name"] == "UK"]
+    if not uk.empty:
+        uk = pd.concat([uk.head(63), dx.tail(81 - 63).assign(country_name="UK"), snapshots[-1].loc[
+            snapshots[-1]["country_name"] == "UK"]], sort=False)
+        data = pd.concat([data.loc[data["country_name"] != "UK"], uk], sort=False)
 
-        data = data.reset_index(drop=True)
-        data["active/cases%"] = round(data["active_cases"] / data["cases"], 2)
-        data["deaths/cases%"] = round(data["deaths"] / data["cases"], 2)
+    data = Data.add_ratios(data.reset_index(drop=True), "cases_by_country")
 
-        data.to_pickle("./data-frames/cleansed-data/%s.pkl" % country)
+    print("Writing 'cleansed data' for %d countries" % data["country_name"].nunique())
+    store = Store()
+    store.upsert_many(data, workers=workers)
+    data = store.read()
+    Aggregates().materialize(data, lambda df: Data.add_ratios(df, "cases_by_country"))
+    Arrays().export(data)
 
 
 if __name__ == "__main__":
     data = run(key="09c05c32f8msh142adc1360507a5p1eb1d9jsn26c3269eb8b2", getWorldHistoryData=False)
 
-    print(pd.read_pickle("./data-frames/cleansed-data/UK.pkl").tail(20))
+    print(data.store.read(countries=["UK"]).tail(20))
 
 
@@ -0,0 +1,83 @@
+import numpy as np
+
+"""
+Decimation of long series down to a point budget before they are sent to the browser. Both methods return the
+indices of the points to keep, the first and last point always among them, and skip missing values.
+
+    lttb      Largest Triangle Three Buckets. Keeps the point of each bucket that makes the largest triangle with
+              its neighbouring buckets, which preserves the shape of a line well. This is the one pass variant: the
+              neighbours are the averages of the buckets either side rather than the point picked before, so every
+              bucket is decided at once with numpy instead of one after the other.
+    minmax    The lowest and highest point of each bucket, so no peak is ever lost. Two points per bucket.
+"""
+
+
+def get_buckets(n, buckets, first=0, last=None):
+    # Start of every bucket and the bucket each of the points first..last belongs to
+    last = n if last is None else last
+    starts = np.unique(np.linspace(first, last, buckets + 1)[:-1].astype("int64"))
+    counts = np.diff(np.append(starts, last))
+
+    return starts, counts, np.repeat(np.arange(len(starts)), counts)
+
+
+def get_first_max(values, starts, bucket):
+    # Index of the first largest value in every bucket
+    maxes = np.maximum.reduceat(values, starts)
+    candidates = np.flatnonzero(values == maxes[bucket])
+
+    # Candidates are in bucket order, keep the first one of each bucket
+    buckets = bucket[candidates]
+    return candidates[np.flatnonzero(np.diff(buckets, prepend=-1))]
+
+
+def lttb(x, y, points):
+    n = len(y)
+    if points >= n or points < 3:
+        return np.arange(n)
+
+    # Everything but the first and last point split into points - 2 buckets
+    starts, counts, bucket = get_buckets(n, points - 2, 1, n - 1)
+    mean_x = np.add.reduceat(x[1:n - 1], starts - 1) / counts
+    mean_y = np.add.reduceat(y[1:n - 1], starts - 1) / counts
+
+    # The buckets either side, the first and last point standing in at the ends
+    previous_x = np.concatenate([[x[0]], mean_x[:-1]])[bucket]
+    previous_y = np.concatenate([[y[0]], mean_y[:-1]])[bucket]
+    next_x = np.concatenate([mean_x[1:], [x[-1]]])[bucket]
+    next_y = np.concatenate([mean_y[1:], [y[-1]]])[bucket]
+
+    px = x[1:n - 1]
+    py = y[1:n - 1]
+    area = np.abs((previous_x - next_x) * (py - previous_y) - (previous_x - px) * (next_y - previous_y))
+
+    return np.concatenate([[0], get_first_max(area, starts - 1, bucket) + 1, [n - 1]])
+
+
+def min_max(x, y, points):
+    n = len(y)
+    if points >= n or points < 4:
+        return np.arange(n)
+
+    # The first and last point take two of the points, the rest go two to a bucket
+    starts, counts, bucket = get_buckets(n, (points - 2) // 2, 1, n - 1)
+    highest = get_first_max(y[1:n - 1], starts - 1, bucket) + 1
+    lowest = get_first_max(-y[1:n - 1], starts - 1, bucket) + 1
+
+    return np.unique(np.concatenate([[0], lowest, highest, [n - 1]]))
+
+
+methods = {"lttb": lttb, "minmax": min_max}
+
+
+def downsample(x, y, points, method="lttb"):
+    # x has to be numeric and increasing, e.g. datetime64 values viewed as int64
+    if len(y) <= points:
+        return np.arange(len(y))
+
+    valid = np.flatnonzero(~np.isnan(y))
+
+    x = np.asarray(x, dtype="float64")[valid]
+    y = np.asarray(y, dtype="float64")[valid]
+
+    return valid[methods[method](x, y, points)]
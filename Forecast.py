@@ -0,0 +1,288 @@
+import atexit
+import hashlib
+import os
+import os.path
+import tempfile
+import threading
+import time
+import warnings
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+"""
+Curve fitting for every country, metric and model in one go. Fits run in a process pool and results are kept in a
+tidy table (one row per country/label/model) that is saved between runs, so a nightly run only refits the series
+whose data actually changed since the last one.
+
+The models live at module level rather than as lambdas so they can be sent to the worker processes, and they all
+work on whole numpy arrays. scipy is only imported by the first fit, the web app imports this module but most
+workers never fit anything and scipy.optimize alone takes half a second to import.
+"""
+
+
+def exp(x, e, b):
+    return np.power(x, e) + b
+
+
+def exp_zero(x, e):
+    return np.power(x, e)
+
+
+def sigmoid(x, e, b):
+    return 1 / (1 + np.power(e, -x)) + b
+
+
+def sigmoid_zero_y(x, e):
+    return 1 / (1 + np.power(e, -x))
+
+
+models = {"exp": exp,
+          "exp_zero": exp_zero,
+          "sigmoid": sigmoid,
+          "sigmoid_zero_y": sigmoid_zero_y}
+
+
+def write_pickle(value, path):
+    # Through a temp file of its own, two processes saving at once can't rename each other's half written file
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    descriptor, temp = tempfile.mkstemp(prefix="." + os.path.basename(path) + ".", suffix=".tmp", dir=directory)
+    os.close(descriptor)
+    try:
+        pd.to_pickle(value, temp)
+        os.replace(temp, path)
+    except BaseException:
+        os.remove(temp)
+        raise
+
+
+def get_hash(y):
+    return hashlib.sha1(np.ascontiguousarray(y, dtype="float64").tobytes()).hexdigest()
+
+
+def fit_curve(function, y, days, p0=None):
+    from scipy import optimize
+
+    x = np.arange(len(y), dtype="float64")
+
+    popt, popc = optimize.curve_fit(function, x, y, p0=p0)
+    projection = function(np.arange(len(y) + days, dtype="float64"), *popt)
+    rmse = float(np.sqrt(np.mean((function(x, *popt) - y) ** 2)))
+
+    return popt, popc, projection, rmse
+
+
+def fit_row(country, label, model, start_date, days, y):
+    from scipy import optimize
+
+    row = {"country": country, "label": label, "model": model, "start_date": start_date, "days": days,
+           "data_hash": get_hash(y), "points": len(y), "params": None, "covariance": None, "projection": None,
+           "rmse": np.nan, "error": None}
+
+    try:
+        # Plenty of countries have too little data for a good fit, that is recorded in "error" instead of warned about
+        with np.errstate(all="ignore"), warnings.catch_warnings():
+            warnings.simplefilter("ignore", optimize.OptimizeWarning)
+            row["params"], row["covariance"], row["projection"], row["rmse"] = fit_curve(models[model], y, days)
+    except Exception as e:
+        row["error"] = str(e)
+
+    return row
+
+
+class FitCache:
+    """
+    Fitted parameters keyed by (country, label, model, start date, data hash), kept on disk between runs. A repeat
+    request for the same data is answered without fitting. When the data has only grown by a day since the last fit,
+    the previous parameters are used as the starting point, which converges in a handful of iterations. The least
+    recently used entries are dropped once max_entries is reached.
+
+    New entries are saved every save_every fits or save_interval seconds, whichever comes first, and when the process
+    exits. Saving pickles a copy, fits carry on while it is written. Entries another process saved since (another
+    web worker, Forecast.run, see seed) are merged in when the file changes, so a fit made anywhere is only made once.
+    """
+
+    def __init__(self, path="./data-frames/forecasts/fit-cache.pkl", max_entries=4096, save_every=64,
+                 save_interval=60):
+        self.path = path
+        self.max_entries = max_entries
+        self.save_every = save_every
+        self.save_interval = save_interval
+        self.hits = 0
+        self.warm_starts = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        # Read on first use, not every worker that creates a Graphs gets to fit anything
+        self.entries = None
+        self.mtime = None
+        self.unsaved = 0
+        self.saved = time.monotonic()
+        self.saving = threading.Lock()
+        atexit.register(self.save)
+
+    def load(self):
+        # Called with the lock held. This process's entries win over the file's, they are at least as new
+        mtime = os.path.getmtime(self.path) if os.path.isfile(self.path) else None
+        if self.entries is None or mtime != self.mtime:
+            entries = pd.read_pickle(self.path) if mtime is not None else OrderedDict()
+            if self.entries is not None:
+                entries.update(self.entries)
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+            self.entries, self.mtime = entries, mtime
+
+        return self.entries
+
+    def fit(self, country, label, function, start_date, y, days):
+        model = function.__name__
+        if models.get(model) is not function:
+            # Only the named models can be told apart reliably, anything else is fitted every time
+            popt, popc, projection, rmse = fit_curve(function, y, days)
+            return popt, popc, projection
+
+        key = (country, label, model, start_date, get_hash(y))
+        with self.lock:
+            self.load()
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+            previous = self.entries.get(key[:-1] + (get_hash(y[:-1]),))
+
+        if entry is not None:
+            popt, popc = entry
+            return popt, popc, function(np.arange(len(y) + days, dtype="float64"), *popt)
+
+        p0 = previous[0] if previous is not None else None
+        popt, popc, projection, rmse = fit_curve(function, y, days, p0=p0)
+
+        with self.lock:
+            if p0 is not None:
+                self.warm_starts += 1
+            else:
+                self.misses += 1
+
+            self.entries[key] = (popt, popc)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+            self.unsaved += 1
+            due = self.unsaved >= self.save_every or time.monotonic() - self.saved >= self.save_interval
+
+        if due:
+            self.save()
+
+        return popt, popc, projection
+
+    def save(self):
+        # Only one thread saves at a time, the others leave their entries for it or the next save
+        if not self.saving.acquire(blocking=False):
+            return
+
+        try:
+            with self.lock:
+                if not self.unsaved:
+                    return
+                entries = OrderedDict(self.load())
+                self.unsaved = 0
+                self.saved = time.monotonic()
+
+            write_pickle(entries, self.path)
+            with self.lock:
+                # Not a change to read back on the next fit
+                self.mtime = os.path.getmtime(self.path)
+        finally:
+            self.saving.release()
+
+    def seed(self, rows):
+        # Fits made elsewhere, Forecast.run's rows, keyed the way fit keys them. Saved straight away so the web
+        # workers pick them up
+        with self.lock:
+            self.load()
+            for row in rows:
+                if isinstance(row["params"], np.ndarray):
+                    key = (row["country"], row["label"], row["model"], row["start_date"], row["data_hash"])
+                    self.entries[key] = (row["params"], row["covariance"])
+                    self.entries.move_to_end(key)
+                    self.unsaved += 1
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+        self.save()
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "warm_starts": self.warm_starts, "misses": self.misses,
+                    "entries": len(self.load())}
+
+
+class Forecast:
+    key = ["country", "label", "model", "start_date", "days"]
+
+    def __init__(self, graphs, path="./data-frames/forecasts/forecasts.pkl", workers=None):
+        self.graphs = graphs
+        self.path = path
+        self.workers = workers
+
+        if os.path.isfile(path):
+            self.results = pd.read_pickle(path)
+        else:
+            self.results = pd.DataFrame(columns=self.key + ["data_hash", "points", "params", "covariance",
+                                                            "projection", "rmse", "error"])
+
+    def run(self, countries, labels, start_date, days, models_to_fit=None):
+        models_to_fit = models_to_fit or list(models)
+        previous = {tuple(row[key] for key in self.key): row for row in self.results.to_dict("records")}
+
+        kept = []
+        jobs = []
+        for country in countries:
+            data = self.graphs.get_data(country=country)
+
+            for label in labels:
+                y = self.graphs.get_fit_series(data, label, start_date)
+                data_hash = get_hash(y)
+
+                for model in models_to_fit:
+                    row = previous.get((country, label, model, start_date, days))
+                    if row is not None and row["data_hash"] == data_hash:
+                        kept.append(row)
+                    else:
+                        jobs.append((country, label, model, start_date, days, y))
+
+        print("Fitting %d series, %d unchanged" % (len(jobs), len(kept)))
+
+        fitted = []
+        if jobs:
+            with ProcessPoolExecutor(max_workers=self.workers) as pool:
+                fitted = list(pool.map(fit_row, *zip(*jobs), chunksize=max(1, len(jobs) // 64)))
+
+        # Keep results for anything not part of this run, replace everything that was
+        done = {tuple(row[key] for key in self.key) for row in kept + fitted}
+        others = [row for key, row in previous.items() if key not in done]
+
+        self.results = pd.DataFrame(others + kept + fitted, columns=self.results.columns)
+        self.save()
+
+        # Graphs.predict fits the same series (Graphs.get_fit_series), with these it has nothing left to fit
+        self.graphs.fits.seed(kept + fitted)
+
+        return self.results
+
+    def get_projection(self, country, label, model, start_date, days):
+        rows = self.results
+        rows = rows.loc[(rows["country"] == country) & (rows["label"] == label) & (rows["model"] == model) &
+                        (rows["start_date"] == start_date) & (rows["days"] == days)]
+        if rows.empty or rows.iloc[0]["projection"] is None:
+            return None
+
+        projection = rows.iloc[0]["projection"]
+        return pd.DataFrame({label: projection,
+                             "statistic_taken_at": self.graphs.get_dates(len(projection), start_date)})
+
+    def save(self):
+        write_pickle(self.results, self.path)
@@ -1,27 +1,170 @@
 import plotly as pl
+import numpy as np
 import pandas as pd
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from scipy import optimize
+import base64
+import glob
+import hashlib
 import json
+import os.path
+import threading
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+import Downsample
+import Forecast
+from Arrays import Arrays
+from Countries import normalize
+from Snapshots import Snapshots
+from Store import Store
+from Writer import Writer
+
+
+class FrameCache:
+    """
+    Process wide LRU cache of parsed, date indexed country data frames. An entry is only served while the
+    modification time of the file it was loaded from is unchanged, so a refresh by Data.run is picked up on the
+    next request. Entries are evicted least recently used first once max_bytes is exceeded.
+    """
+
+    def __init__(self, max_bytes=256 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self.frames = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, mtime, load):
+        with self.lock:
+            entry = self.frames.get(key)
+            if entry is not None and entry[0] == mtime:
+                self.frames.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        data = load()
+        size = int(data.memory_usage(deep=True).sum())
+
+        with self.lock:
+            if key in self.frames:
+                self.bytes -= self.frames.pop(key)[2]
+            self.frames[key] = (mtime, data, size)
+            self.bytes += size
+
+            while self.bytes > self.max_bytes and len(self.frames) > 1:
+                self.bytes -= self.frames.popitem(last=False)[1][2]
+
+        return data
+
+    def clear(self):
+        with self.lock:
+            self.frames.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self.frames), "bytes": self.bytes}
+
+
+class FigureCache:
+    """
+    Serialised figures keyed by (chart type, labels, countries, date range), least recently used first out once there
+    are max_entries. Keys come from query parameters, so without a bound every combination a client tries would stay.
+    All entries are built from one data version, the first time one is asked for with a newer version the others are
+    all dropped. Alongside the JSON an entry holds an ETag and Last-Modified time so the web layer can answer
+    conditional requests with a 304.
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.figures = OrderedDict()
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, version, build):
+        with self.lock:
+            if self.version is None or version > self.version:
+                self.figures.clear()
+                self.version = version
+
+            entry = self.figures.get(key)
+            if entry is not None and entry["version"] == version:
+                self.figures.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        figure = build()
+        entry = {"version": version,
+                 "json": figure,
+                 "etag": hashlib.sha1(figure.encode("utf-8")).hexdigest(),
+                 "last_modified": datetime.utcfromtimestamp(version)}
+
+        with self.lock:
+            # Built from a version a refresh has since replaced, serve it this once but don't keep it
+            if version == self.version:
+                self.figures[key] = entry
+                self.figures.move_to_end(key)
+                while len(self.figures) > self.max_entries:
+                    self.figures.popitem(last=False)
+
+        return entry
+
+    def clear(self):
+        with self.lock:
+            self.figures.clear()
+            self.version = None
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self.figures)}
 
 
 class Graphs:
+    cache = FrameCache()
+    figures = FigureCache()
 
     def __init__(self):
         pd.set_option('display.max_rows', 300)
         pd.set_option('display.max_columns', 500)
         pd.set_option('display.width', 1000)
         self.date = datetime.today().strftime("%Y-%m-%d")
-
-        self.path = "./data-frames/countries-affected/countries-affected_%s.pkl" % self.date
-        self.countries = list(pd.read_pickle(self.path)["affected_countries"])
+        self.affected = None
+        self.known = None
 
         self.path = "./data-frames/cleansed-data/"
+        self.store = Store()
+        self.arrays = Arrays()
+        self.snapshots = Snapshots()
+
+        self.functions = dict(Forecast.models)
+        self.fits = Forecast.FitCache()
+
+    @property
+    def countries(self):
+        # Read on first use rather than when the app starts, and again whenever a refresh (in this process or another)
+        # has written a newer list. Today's list only exists once today's refresh has run, until then use the newest
+        # one there is
+        if self.snapshots.exists():
+            version = self.snapshots.mtime()
+            if self.affected is None or self.affected[0] != version:
+                affected = self.snapshots.as_of("countries_affected", columns=[])["affected_countries"]
+                self.affected = (version, list(affected))
+        else:
+            paths = sorted(glob.glob("./data-frames/countries-affected/countries-affected_*.pkl"))
+            version = (paths[-1], os.path.getmtime(paths[-1])) if paths else None
+            if self.affected is None or self.affected[0] != version:
+                self.affected = (version, list(pd.read_pickle(paths[-1])["affected_countries"]) if paths else [])
 
-        self.functions = {"exp": lambda x, e, b: x ** e + b,
-                          "exp_zero": lambda x, e: x ** e,
-                          "sigmoid": lambda x, e, b: (1 / (1 + e ** (-x))) + b,
-                          "sigmoid_zero_y": lambda x, e: (1 / (1 + e ** (-x)))}
+        return self.affected[1]
 
     def get_dates(self, period, start):
         dates = pd.date_range(start=start, periods=period)
@@ -29,45 +172,50 @@ class Graphs:
 
     def predict(self, label, country, function, start_date, days):
 
-        df = pd.read_pickle("./data-frames/cleansed-data/%s.pkl" % country)
-        df["statistic_taken_at"] = pd.to_datetime(df["statistic_taken_at"])
-        mask = (df["statistic_taken_at"] >= datetime.strptime(start_date, "%Y-%m-%d"))
-        df = df.loc[mask]
+        y = self.get_fit_series(self.get_data(country=country), label, start_date)
         df_to_return = pd.DataFrame()
 
-        df = df.loc[df[label] > 0]
-
-        x = list(range(len(df[label])))
-
-        popt, popc = optimize.curve_fit(function, x, df[label])
-        df_to_return[label] = [function(x, *popt) for x in list(range(len(df[label]) + days))]
+        popt, popc, projection = self.fits.fit(country, label, function, start_date, y, days)
+        df_to_return[label] = projection
 
         df_to_return["statistic_taken_at"] = self.get_dates(len(df_to_return[label]), start_date)
 
         return [df_to_return, popt, popc]
 
-    def get_data_between_dates(self, data, start_date=None, end_date=None):
+    def index_by_date(self, data):
+        # Frames from the cache are already sorted and date indexed, anything else gets an indexed copy
+        if isinstance(data.index, pd.DatetimeIndex) and data.index.is_monotonic_increasing:
+            return data
+
+        dates = pd.to_datetime(data["statistic_taken_at"])
+        data = data.assign(statistic_taken_at=dates)
+        data.index = pd.DatetimeIndex(dates, name=None)
 
-        data["statistic_taken_at"] = pd.to_datetime(data["statistic_taken_at"])
+        return data.sort_index(kind="mergesort")
 
-        if start_date == end_date:
-            end_date = datetime.strptime(start_date, "%Y-%m-%d") + timedelta(days=1)
-            end_date = str(end_date).split(" ")[0]
+    def get_data_between_dates(self, data, start_date=None, end_date=None):
+        data = self.index_by_date(data)
 
-        if start_date is not None and end_date is not None:
-            mask = (data["statistic_taken_at"] >= datetime.strptime(start_date, "%Y-%m-%d"))
-            data = data.loc[mask]
-            mask = (data["statistic_taken_at"] <= datetime.strptime(end_date, "%Y-%m-%d"))
-            data = data.loc[mask]
+        # Both days are inclusive, all of end_date up to midnight included. Binary search the sorted index and slice
+        # rather than masking the whole frame
+        start = 0
+        end = len(data)
+        if start_date is not None:
+            start = data.index.searchsorted(datetime.strptime(start_date, "%Y-%m-%d"), side="left")
+        if end_date is not None:
+            end = data.index.searchsorted(datetime.strptime(end_date, "%Y-%m-%d") + timedelta(days=1), side="left")
 
-        elif start_date is not None:
-            mask = (data["statistic_taken_at"] >= datetime.strptime(start_date, "%Y-%m-%d"))
-            data = data.loc[mask]
+        return data.iloc[start:end]
 
-        elif end_date is not None:
-            mask = (data["statistic_taken_at"] <= datetime.strptime(end_date, "%Y-%m-%d"))
-            data = data.loc[mask]
-        return data
+    def get_fit_series(self, data, label, start_date):
+        # What a curve is fitted to, the positive values from start_date on. Forecast.run fits the same series and
+        # seeds the fit cache with its results, so predict answers from them
+        y = self.get_data_between_dates(data, start_date)[label].to_numpy(dtype="float64", na_value=np.nan)
+        return y[y > 0]
+
+    def get_windows(self, countries, start_date=None, end_date=None, df=None):
+        return OrderedDict((country, self.get_data_between_dates(self.get_data(df, country), start_date, end_date))
+                           for country in countries)
 
     def format_dates(self, data):
 
@@ -89,21 +237,173 @@ class Graphs:
     def get_data(self, df=None, country=None):
 
         if df is not None:
-            data = df
+            return df
+
+        if self.arrays.exists():
+            return self.cache.get(country, self.arrays.mtime(), lambda: self.arrays.get_frame(country))
+
+        if self.store.exists():
+            return self.cache.get(country, self.store.mtime(), lambda: self.load_data(country))
+
+        path = self.get_path(country)
+        return self.cache.get(country, os.path.getmtime(path), lambda: self.load_data(country))
+
+    def load_data(self, country):
+        if self.store.exists():
+            data = self.store.read(countries=[country])
         else:
-            data = pd.read_pickle(self.path + country + ".pkl")
+            data = pd.read_pickle(self.get_path(country))
+
+        return self.index_by_date(data)
+
+    def get_paths(self):
+        # {country: pickle} from a listing of the folder. Pickles are only ever opened through this, never by a path
+        # made from a name as it was asked for
+        if not os.path.isdir(self.path):
+            return {}
+
+        return {normalize(name[:-len(".pkl")]): os.path.join(self.path, name)
+                for name in os.listdir(self.path) if name.endswith(".pkl")}
+
+    def get_path(self, country):
+        path = self.get_paths().get(country)
+        if path is None:
+            raise KeyError("No data for %r" % country)
+
+        return path
+
+    def get_known(self):
+        # The countries there is data for, the only ones the app asks for. The store's are read again after every
+        # refresh, in whichever process it ran
+        if self.arrays.exists():
+            return set(self.arrays.get_countries())
+
+        if self.store.exists():
+            mtime = self.store.mtime()
+            if self.known is None or self.known[0] != mtime:
+                self.known = (mtime, set(self.store.get_countries()))
+            return self.known[1]
+
+        return set(self.get_paths())
+
+    def get_long_data(self, labels, countries, start_date=None, end_date=None, df=None):
+        # One row per (country, date) with a float64 column per label, stitched together from the cached windows
+        if df is None and self.arrays.exists():
+            return self.get_long_arrays(labels, countries, start_date, end_date)
+
+        windows = self.get_windows(countries, start_date, end_date, df)
+
+        values = [data[labels].to_numpy(dtype="float64", na_value=np.nan) for data in windows.values()]
+        dates = [data.index.values for data in windows.values()]
+        lengths = [len(data) for data in windows.values()]
+
+        return self.build_long_data(labels, list(windows.keys()), values, dates, lengths)
+
+    def get_long_arrays(self, labels, countries, start_date=None, end_date=None):
+        # The same from the mapped export, the concatenation is the only copy made of the data
+        values = []
+        dates = []
+        lengths = []
+        countries = list(OrderedDict.fromkeys(countries))
+        for country in countries:
+            days, columns = self.arrays.get_window(country, labels, start_date, end_date)
+            values.append(np.column_stack(columns).astype("float64") if columns else np.empty((len(days), 0)))
+            dates.append(days)
+            lengths.append(len(days))
+
+        return self.build_long_data(labels, countries, values, dates, lengths)
+
+    def build_long_data(self, labels, countries, values, dates, lengths):
+        data = pd.DataFrame(np.concatenate(values) if values else np.empty((0, len(labels))), columns=labels)
+        data.insert(0, "country_name", np.repeat(countries, lengths))
+        dates = pd.DatetimeIndex(np.concatenate(dates).astype("datetime64[ns]") if dates else [])
+        data.insert(1, "statistic_taken_at", dates.strftime("%Y-%m-%d"))
+        # Numeric time for downsampling, which needs real distances between the points
+        data["time"] = dates.asi8
 
         return data
 
+    def get_ranges(self, data, countries):
+        # Rows are grouped by country in the order asked for, so each country is a contiguous slice
+        ends = np.searchsorted(pd.Categorical(data["country_name"], categories=countries, ordered=True).codes,
+                               np.arange(len(countries)), side="right")
+        starts = np.concatenate([[0], ends[:-1]]).astype("int64")
+
+        return zip(countries, starts, ends)
+
+    def get_points(self, times, values, points=None, downsample="lttb"):
+        # Rows of one trace to keep, all of them unless a point budget is given
+        if points is None or len(values) <= points:
+            return slice(None)
+
+        return Downsample.downsample(times, values, points, downsample)
+
+    def get_x(self, dates, times):
+        # Days one apart are sent as the first date and a step, anything else (downsampled, gaps) as milliseconds
+        # since the epoch, both read by a date axis. Either is a fraction of the size of a list of date strings
+        if len(times) == 0:
+            return {"x": []}
+
+        steps = np.diff(times)
+        if len(times) == 1 or (steps == steps[0]).all():
+            return {"x0": dates[0], "dx": int(steps[0] // 10 ** 6) if len(steps) else 86400000}
+
+        return {"x": times // 10 ** 6}
+
+    def get_traces(self, trace, name, labels, countries, start_date=None, end_date=None, df=None, points=None,
+                   downsample="lttb", compact=False, **kwargs):
+        data = self.get_long_data(labels, countries, start_date, end_date, df)
+        countries = list(OrderedDict.fromkeys(countries))
+
+        dates = data["statistic_taken_at"].to_numpy()
+        times = data["time"].to_numpy()
+        columns = {label: data[label].to_numpy() for label in labels}
+
+        traces = []
+        for country, start, end in self.get_ranges(data, countries):
+            for label in labels:
+                rows = self.get_points(times[start:end], columns[label][start:end], points, downsample)
+                x = self.get_x(dates[start:end][rows], times[start:end][rows]) if compact else {
+                    "x": dates[start:end][rows]}
+                traces.append(dict(type=trace,
+                                   y=columns[label][start:end][rows],
+                                   name=name % (label, country),
+                                   **x,
+                                   **kwargs))
+
+        return traces
+
+    def build_figure(self, traces, layout, fig=None, as_dict=False):
+        # Trace dicts are built from clean arrays, so skip plotly's per property validation and add them all at once.
+        # as_dict skips plotly altogether and returns the figure as the plain dict get_json sends to the browser
+        if as_dict and fig is None:
+            return {"data": traces, "layout": layout}
+
+        if fig is None:
+            return pl.graph_objs.Figure(data=traces, layout=pl.graph_objs.Layout(layout), _validate=False)
+
+        fig.add_traces(traces)
+        fig.update_layout(layout)
+        return fig
+
     def scatter(self, title, labels, countries, x_label=None, y_label=None, width=None, height=None, start_date=None,
-                end_date=None, fig=None, df=None):
+                end_date=None, fig=None, df=None, bulk=True, points=None, downsample="lttb", as_dict=False):
 
-        fig = self.get_figure(fig)
+        layout = dict(
+            width=width,
+            height=height,
+            xaxis={'title': {'text': x_label}, 'type': 'date'},
+            yaxis={'title': {'text': y_label, 'font': {'size': 16}}},
+            margin=dict(l=0, r=0, b=0, t=25, pad=0))
 
-        for country in countries:
+        if bulk or as_dict:
+            traces = self.get_traces("scatter", "%s %s", labels, countries, start_date, end_date, df, points,
+                                     downsample, compact=as_dict, mode='markers+lines')
+            return self.build_figure(traces, layout, fig, as_dict)
+
+        fig = self.get_figure(fig)
 
-            data = self.get_data(df, country)
-            data = self.get_data_between_dates(data, start_date, end_date)
+        for country, data in self.get_windows(countries, start_date, end_date, df).items():
             dates = self.format_dates(data)
 
             for label in labels:
@@ -114,23 +414,33 @@ class Graphs:
                     name=label+" "+country,
                 ))
 
-        fig.update_layout(
-            width=width,
-            height=height,
-            xaxis_title={'text': x_label},
-            yaxis_title={'text': y_label, 'font': {'size': 16}},
-            margin=dict(l=0, r=0, b=0, t=25, pad=0))
+        fig.update_layout(**layout)
         return fig
 
     def bar(self, title, labels, countries, x_label=None, y_label=None, width=None, height=None, start_date=None,
-            end_date=None, fig=None, df=None):
+            end_date=None, fig=None, df=None, bulk=True, points=None, downsample="minmax", as_dict=False):
+
+        layout = dict(title={'text': title,
+                             'y': 0.95,
+                             'x': 0.45,
+                             'xanchor': 'center',
+                             'yanchor': 'top',
+                             'font': {'size': 36}},
+                      width=width,
+                      height=height,
+                      barmode="group",
+                      xaxis={'title': {'text': x_label, 'font': {'size': 24}}, 'type': 'date'},
+                      yaxis={'title': {'text': y_label, 'font': {'size': 24}}},
+                      font=dict(size=16))
+
+        if bulk or as_dict:
+            traces = self.get_traces("bar", "%s-%s", labels, countries, start_date, df=df, points=points,
+                                     downsample=downsample, compact=as_dict)
+            return self.build_figure(traces, layout, fig, as_dict)
 
         fig = self.get_figure(fig)
 
-        for country in countries:
-
-            data = self.get_data(df, country)
-            data = self.get_data_between_dates(data, start_date)
+        for country, data in self.get_windows(countries, start_date, df=df).items():
             dates = self.format_dates(data)
 
             for label in labels:
@@ -139,62 +449,166 @@ class Graphs:
                     y=data[label],
                     name=label + "-" + country))
 
-        fig.update_layout(title={'text': title,
-                                 'y': 0.95,
-                                 'x': 0.45,
-                                 'xanchor': 'center',
-                                 'yanchor': 'top',
-                                 'font': {'size': 36}},
-                          width=width,
-                          height=height,
-                          barmode="group",
-                          xaxis_title={'text': x_label, 'font': {'size': 24}},
-                          yaxis_title={'text': y_label, 'font': {'size': 24}},
-                          font=dict(size=16))
+        fig.update_layout(**layout)
         return fig
 
     def pi(self, title, labels, countries, x_label=None, y_label=None, width=None, height=None, date=None,
-           fig=None, df=None):
-        values = []
-        fig = self.get_figure(fig)
-        if date is None:
-            date = datetime.now().strftime("%Y-%m-%d")
-            print(date)
+           fig=None, df=None, as_dict=False):
+        # One pie, either one label across countries or several labels of one country, of the newest values on or
+        # before date
+        dates, values = self.get_latest(labels, countries, date, df)
 
+        traces = []
         if len(countries) > 1 and len(labels) == 1:
-            print(True)
-            label = labels[0]
-            for country in countries:
-                data = self.get_data(df, country)
-                data = self.get_data_between_dates(data, date, date)
-                print(data[label])
-                values.append(float(data[label]))
-
-                fig.add_trace(pl.graph_objs.Pie(title={'text': label.capitalize(),
-                                                       'font': {'size': 36}},
-                                                labels=countries,
-                                                values=values,
-                                                hole=0.3))
+            traces.append(dict(type="pie",
+                               title={'text': labels[0].capitalize(), 'font': {'size': 36}},
+                               labels=list(countries),
+                               values=values[:, 0],
+                               hole=0.3))
 
         elif len(labels) > 1 and len(countries) == 1:
-            country = countries[0]
+            traces.append(dict(type="pie",
+                               title={'text': title + " " + countries[0], 'font': {'size': 36}},
+                               labels=list(labels),
+                               values=values[0],
+                               hole=0.3))
+
+        return self.build_figure(traces, {}, fig, as_dict)
+
+    def get_series(self, labels, countries, start_date=None, end_date=None, points=None, downsample="lttb"):
+        # {country: {"dates": [...], label: [...]}} with missing values as null. Labels share their dates, so with a
+        # point budget a country keeps every date any of its labels would keep
+        data = self.get_long_data(labels, countries, start_date, end_date)
+        countries = list(OrderedDict.fromkeys(countries))
+
+        dates = data["statistic_taken_at"].to_numpy()
+        times = data["time"].to_numpy()
+        columns = {label: data[label].to_numpy() for label in labels}
+
+        series = OrderedDict()
+        for country, start, end in self.get_ranges(data, countries):
+            if start == end:
+                continue
+
+            rows = slice(start, end)
+            if points is not None and end - start > points:
+                rows = np.unique(np.concatenate([
+                    np.arange(start, end)[self.get_points(times[start:end], columns[label][start:end], points,
+                                                          downsample)] for label in labels]))
+
+            series[country] = {"dates": dates[rows].tolist()}
+            for label in labels:
+                values = columns[label][rows]
+                series[country][label] = np.where(np.isnan(values), None, values).tolist()
+
+        return series
+
+    def get_latest(self, labels, countries, date=None, df=None):
+        # The newest row of each country, or the newest on or before date: the days as datetime64[D] and a countries by
+        # labels float64 array, NaT and NaN for a country without one. A lookup in the mapped export when there is one
+        if df is None and self.arrays.exists():
+            return self.arrays.get_latest(countries, labels, date)
+
+        dates = np.full(len(countries), np.datetime64("NaT"), dtype="datetime64[D]")
+        values = np.full((len(countries), len(labels)), np.nan)
+        for i, country in enumerate(countries):
+            data = self.get_data_between_dates(self.get_data(df, country), end_date=date)
+            if not data.empty:
+                dates[i] = data.index[-1].to_datetime64().astype("datetime64[D]")
+                values[i] = data[labels].iloc[-1].to_numpy(dtype="float64", na_value=np.nan)
+
+        return dates, values
+
+    def get_values(self, labels, countries, date=None):
+        # {country: {"date": ..., label: value}} from the newest row on or before date, as the pie charts show
+        dates, latest = self.get_latest(labels, countries, date)
+
+        values = OrderedDict()
+        for country, day, row in zip(countries, dates, latest):
+            if np.isnat(day):
+                values[country] = None
+                continue
+
+            values[country] = {"date": str(day)}
+            for label, value in zip(labels, row):
+                values[country][label] = None if np.isnan(value) else float(value)
+
+        return values
+
+    def get_typed_array(self, values):
+        # plotly.js (2.28 and later) reads {"dtype": ..., "bdata": ...} as a typed array of the base64 encoded,
+        # little endian values. Whole numbers that fit go as int32, the rest as float32 when that loses nothing
+        values = np.asarray(values)
+        if values.dtype.kind == "b":
+            values = values.astype("uint8")
+
+        dtype = "f8"
+        if values.size and values.dtype.kind in "iuf" and np.isfinite(values).all() and \
+                (values == np.trunc(values)).all() and values.min() >= -2 ** 31 and values.max() < 2 ** 31:
+            dtype = "i4"
+        elif values.dtype.kind == "f" and np.array_equal(values.astype("float32"), values, equal_nan=True):
+            dtype = "f4"
+
+        return {"dtype": dtype, "bdata": base64.b64encode(values.astype("<" + dtype).tobytes()).decode("ascii")}
+
+    def encode(self, value):
+        # Numeric arrays as typed arrays, everything else as plain JSON types. Unset (None) properties are left out
+        # like plotly does, NaN outside of an array is sent as null
+        if isinstance(value, dict):
+            return {key: self.encode(item) for key, item in value.items() if item is not None}
+        if isinstance(value, (list, tuple)):
+            return [self.encode(item) for item in value]
+        if isinstance(value, np.ndarray):
+            return self.get_typed_array(value) if value.dtype.kind in "biuf" else self.encode(value.tolist())
+        if isinstance(value, np.generic):
+            value = value.item()
+        if isinstance(value, float) and value != value:
+            return None
+
+        return value
+
+    def dumps(self, value):
+        if orjson is not None:
+            return orjson.dumps(value, option=orjson.OPT_SERIALIZE_NUMPY).decode("utf-8")
+
+        return json.dumps(value, separators=(",", ":"), default=str)
 
-            data = self.get_data(df, country)
-            data = self.get_data_between_dates(data, date, date)
+    def get_json(self, fig):
+        # Accepts a plotly figure or the plain dict from build_figure(..., as_dict=True)
+        if not isinstance(fig, dict):
+            fig = fig.to_plotly_json()
 
-            for label in labels:
-                values.append(float(data[label]))
+        return self.dumps(self.encode(fig))
 
-            fig.add_trace(pl.graph_objs.Pie(title={'text': title + " " + country,
-                                                   'font': {'size': 36}},
-                                            labels=labels,
-                                            values=values,
-                                            hole=0.3))
+    def get_version(self, countries):
+        # A refresh marks its version once everything is written, the export is also rebuilt by hand (Data.cl)
+        if self.arrays.exists():
+            return max(self.arrays.mtime(), Writer.get_version())
 
-        return fig
+        if self.store.exists():
+            return self.store.mtime()
 
-    def get_json(self, fig):
-        return json.dumps(fig, cls=pl.utils.PlotlyJSONEncoder)
+        return max(os.path.getmtime(self.get_path(country)) for country in countries)
+
+    def get_figure_json(self, chart, title, labels, countries, **kwargs):
+        # "Today" has to be part of the key, otherwise yesterday's pie would be served after midnight
+        if chart == "pi" and kwargs.get("date") is None:
+            kwargs["date"] = datetime.now().strftime("%Y-%m-%d")
+
+        key = (chart, title, tuple(labels), tuple(countries), tuple(sorted(kwargs.items())))
+
+        # Straight to a dict, plotly's figure objects are only for showing a chart from Python
+        options = dict(kwargs, as_dict=True)
+
+        return self.figures.get(key, self.get_version(countries),
+                                lambda: self.get_json(getattr(self, chart)(title, labels, countries, **options)))
+
+    def get_data_json(self, name, labels, countries, **kwargs):
+        # Same caching as the figures, for the plain data behind them ("series" or "values")
+        key = (name, tuple(labels), tuple(countries), tuple(sorted(kwargs.items())))
+
+        return self.figures.get(key, self.get_version(countries),
+                                lambda: self.dumps(getattr(self, "get_" + name)(labels, countries, **kwargs)))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,247 @@
+import functools
+import inspect
+import json
+import os
+import os.path
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import nullcontext
+from datetime import datetime
+
+"""
+Timing spans, counters and histograms for the refresh and the web app, kept in memory and rendered in the
+Prometheus text format by the app's /metrics route. Every finished span is also written as one JSON object per line
+to data-frames/updates-log.jsonl, together with a summary line per refresh, e.g.
+
+    {"time": "2020-04-05T20:15:31", "event": "span", "stage": "update_country_history", "country": "UK", ...}
+    {"time": "2020-04-05T20:16:02", "event": "run", "seconds": 31.2, "fetched_bytes": 5123400, ...}
+
+Histograms are only labelled by stage, per country timings would be too many series, they are in the log instead.
+Set METRICS=0 to turn spans and counters off, a disabled span is a shared no-op context manager.
+
+A process without a /metrics route of its own (the refresher, python Scheduler.py) dumps its metrics to a file after
+every refresh, and the app renders them next to its own with a label telling them apart (see dump and merge).
+"""
+
+buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, float("inf"))
+
+null_span = nullcontext()
+
+
+class Span:
+
+    def __init__(self, metrics, stage, labels):
+        self.metrics = metrics
+        self.stage = stage
+        self.labels = labels
+
+    def __enter__(self):
+        stack = self.metrics.get_stack()
+        self.parent = stack[-1].stage if stack else None
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, kind, error, traceback):
+        seconds = time.perf_counter() - self.start
+        self.metrics.get_stack().pop()
+
+        self.metrics.observe("covid_stage_seconds", seconds, stage=self.stage)
+        if kind is not None:
+            self.metrics.inc("covid_stage_errors_total", stage=self.stage)
+
+        self.metrics.log("span", stage=self.stage, parent=self.parent, seconds=round(seconds, 6),
+                         error=None if kind is None else "%s: %s" % (kind.__name__, error), **self.labels)
+        return False
+
+
+class Metrics:
+
+    def __init__(self, enabled=True, log_path="./data-frames/updates-log.jsonl"):
+        self.enabled = enabled
+        self.log_path = log_path
+
+        self.counters = OrderedDict()
+        self.gauges = OrderedDict()
+        self.histograms = OrderedDict()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def get_stack(self):
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def span(self, stage, **labels):
+        if not self.enabled:
+            return null_span
+
+        return Span(self, stage, labels)
+
+    def timed(self, stage, label=None):
+        # Decorator, label names an argument of the function whose value is logged with the span, e.g. country
+        def decorate(function):
+            signature = inspect.signature(function)
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+
+                labels = {}
+                if label is not None:
+                    arguments = signature.bind(*args, **kwargs)
+                    arguments.apply_defaults()
+                    labels[label] = arguments.arguments[label]
+
+                with Span(self, stage, labels):
+                    return function(*args, **kwargs)
+
+            return wrapper
+
+        return decorate
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * len(buckets), 0.0, 0]
+
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+                    break
+            histogram[1] += value
+            histogram[2] += 1
+
+    def total(self, name):
+        # A counter summed over all of its labels
+        with self.lock:
+            return sum(value for (key, labels), value in self.counters.items() if key == name)
+
+    def log(self, event, **fields):
+        if self.log_path is None:
+            return
+
+        line = json.dumps(OrderedDict([("time", datetime.now().isoformat(timespec="seconds")), ("event", event)] +
+                                      [(key, value) for key, value in fields.items() if value is not None]),
+                          default=str)
+        try:
+            with self.lock, open(self.log_path, "a") as file:
+                file.write(line + "\n")
+        except OSError:
+            # Losing a log line is better than failing the refresh it describes
+            pass
+
+    def dump(self, path):
+        # Through a temp file of its own, a reader sees the previous dump or this one
+        with self.lock:
+            state = {"counters": [[name, labels, value] for (name, labels), value in self.counters.items()],
+                     "gauges": [[name, labels, value] for (name, labels), value in self.gauges.items()],
+                     "histograms": [[name, labels, histogram] for (name, labels), histogram in self.histograms.items()]}
+
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        descriptor, temp = tempfile.mkstemp(prefix="." + os.path.basename(path) + ".", suffix=".tmp", dir=directory)
+        try:
+            with os.fdopen(descriptor, "w") as file:
+                json.dump(state, file, default=str)
+            os.replace(temp, path)
+        except BaseException:
+            os.remove(temp)
+            raise
+
+    @classmethod
+    def load(cls, path):
+        # A dump as a Metrics of its own, empty if there isn't one (yet)
+        loaded = cls(log_path=None)
+        try:
+            with open(path) as file:
+                state = json.load(file)
+        except (OSError, ValueError):
+            return loaded
+
+        for kind in ("counters", "gauges", "histograms"):
+            values = getattr(loaded, kind)
+            for name, labels, value in state.get(kind, []):
+                values[(name, tuple(tuple(label) for label in labels))] = value
+
+        return loaded
+
+    def merge(self, other, **labels):
+        # This process's series and other's, each of other's with labels added
+        merged = Metrics(log_path=None)
+        extra = tuple(sorted(labels.items()))
+
+        with self.lock:
+            merged.counters.update(self.counters)
+            merged.gauges.update(self.gauges)
+            merged.histograms.update((key, [list(counts), total, count])
+                                     for key, (counts, total, count) in self.histograms.items())
+
+        with other.lock:
+            for kind in ("counters", "gauges", "histograms"):
+                values = getattr(merged, kind)
+                for (name, series), value in getattr(other, kind).items():
+                    values[(name, series + extra)] = value
+
+        return merged
+
+    def get_labels(self, labels, extra=()):
+        labels = tuple(labels) + tuple(extra)
+        if not labels:
+            return ""
+
+        return "{%s}" % ",".join('%s="%s"' % (key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                                 for key, value in labels)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for kind, values in (("counter", self.counters), ("gauge", self.gauges)):
+                seen = set()
+                # All the series of one metric have to follow its TYPE line
+                for (name, labels), value in sorted(values.items(), key=lambda item: item[0][0]):
+                    if name not in seen:
+                        seen.add(name)
+                        lines.append("# TYPE %s %s" % (name, kind))
+                    lines.append("%s%s %s" % (name, self.get_labels(labels), repr(float(value))))
+
+            seen = set()
+            histograms = sorted(self.histograms.items(), key=lambda item: item[0][0])
+            for (name, labels), (counts, total, count) in histograms:
+                if name not in seen:
+                    seen.add(name)
+                    lines.append("# TYPE %s histogram" % name)
+
+                cumulative = 0
+                for bound, bucket in zip(buckets, counts):
+                    cumulative += bucket
+                    le = "+Inf" if bound == float("inf") else repr(float(bound))
+                    lines.append("%s_bucket%s %d" % (name, self.get_labels(labels, [("le", le)]), cumulative))
+                lines.append("%s_sum%s %s" % (name, self.get_labels(labels), repr(total)))
+                lines.append("%s_count%s %d" % (name, self.get_labels(labels), count))
+
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics(enabled=os.environ.get("METRICS", "1") != "0")
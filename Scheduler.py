@@ -0,0 +1,93 @@
+import threading
+import time
+import traceback
+
+import Data
+from Metrics import metrics
+
+"""
+Runs Data.run on a background thread every `interval` seconds (the API updates roughly every ten minutes) so the
+web app never has to block on a refresh. Data writes every file to a temporary name and renames it into place, so
+requests served while a refresh is running read the previous data until the new files are swapped in. Once a
+refresh has finished every registered listener is called, which is where the caches get invalidated.
+
+Run on its own (python Scheduler.py) there is no /metrics route in the process, so after every refresh its metrics
+are dumped to metrics_path and the app's /metrics renders them along with its own.
+"""
+
+
+class Scheduler:
+    metrics_path = "./data-frames/refresher-metrics.json"
+
+    def __init__(self, key=None, interval=600, getWorldHistoryData=False, workers=8, dump_metrics=False):
+        self.key = key
+        self.interval = interval
+        self.getWorldHistoryData = getWorldHistoryData
+        self.workers = workers
+        self.dump_metrics = dump_metrics
+
+        self.listeners = []
+        self.last_refresh = None
+        self.last_error = None
+
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+        return listener
+
+    def refresh(self):
+        # Only one refresh at a time, a slow refresh makes the next tick wait rather than run alongside it
+        with self.lock:
+            try:
+                Data.run(key=self.key, getWorldHistoryData=self.getWorldHistoryData, workers=self.workers)
+            except Exception as e:
+                self.last_error = e
+                traceback.print_exc()
+                return False
+            finally:
+                # Failed refreshes too, their errors are counted
+                if self.dump_metrics:
+                    metrics.dump(self.metrics_path)
+
+            self.last_refresh = time.time()
+            self.last_error = None
+
+        for listener in self.listeners:
+            try:
+                listener()
+            except Exception:
+                traceback.print_exc()
+
+        return True
+
+    def loop(self, run_now):
+        if run_now:
+            self.refresh()
+
+        while not self.stopped.wait(self.interval):
+            self.refresh()
+
+    def start(self, run_now=True):
+        if self.thread is not None and self.thread.is_alive():
+            return
+
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.loop, args=(run_now,), name="data-refresh", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+
+if __name__ == "__main__":
+    import os
+
+    # Standalone refresher for when the app runs under several workers, see wsgi.py
+    scheduler = Scheduler(key=os.environ.get("RAPIDAPI_KEY"), interval=int(os.environ.get("REFRESH_INTERVAL", 600)),
+                          dump_metrics=True)
+    scheduler.loop(run_now=True)
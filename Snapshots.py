@@ -0,0 +1,221 @@
+import bisect
+import json
+import os
+import os.path
+import re
+import threading
+
+import numpy as np
+import pandas as pd
+
+from Countries import registry
+from Store import Store
+
+"""
+A catalog over the daily snapshot pickles, one per day in each of
+
+    data-frames/cases-by-country/cases-by-country_<date>.pkl
+    data-frames/countries-affected/countries-affected_<date>.pkl
+    data-frames/global-data/world-stats_<date>.pkl
+
+compacted into one Parquet file per set, sorted by the day of the snapshot, which is kept as a "date" column:
+
+    data-frames/store/snapshots/<set>.parquet
+    data-frames/store/snapshots/manifest.json     the days each file holds and the pickles they came from
+
+compact() runs after every refresh and only reads the pickles that are new or changed since the last one.
+
+A set's file is read once after each compaction, the first time it is queried. From then on a range of days is a
+slice found by binary search, countries are a mask over their IDs (the codes of a categorical column, see Countries)
+and only the columns asked for are copied out, so a query takes about the same time however many daily pickles
+there are.
+
+Needs pyarrow, like the store.
+"""
+
+
+class Snapshots:
+    # name: (folder, file name prefix, country column, numeric columns and their dtype)
+    sets = {
+        "cases_by_country": ("./data-frames/cases-by-country/", "cases-by-country_", "country_name", Store.columns),
+        "countries_affected": ("./data-frames/countries-affected/", "countries-affected_", "affected_countries", {}),
+        "world_stats": ("./data-frames/global-data/", "world-stats_", None,
+                        {"total_cases": "Int32", "total_deaths": "Int32", "total_recovered": "Int32",
+                         "new_cases": "Int32", "new_deaths": "Int32", "deaths/cases%": "float32",
+                         "recovered/cases%": "float32"}),
+    }
+
+    pattern = re.compile(r"_(\d{4}-\d{2}-\d{2})\.pkl$")
+
+    def __init__(self, path="./data-frames/store/snapshots/"):
+        self.path = path
+
+        self.loaded = None
+        self.lock = threading.Lock()
+
+    def get_file(self, name):
+        return os.path.join(self.path, name + ".parquet")
+
+    def mtime(self):
+        path = os.path.join(self.path, "manifest.json")
+        return os.path.getmtime(path) if os.path.isfile(path) else 0
+
+    def exists(self):
+        return self.mtime() != 0
+
+    def get_sources(self, name):
+        # {date: (path, mtime)} of the pickles a set has on disk
+        folder, prefix = self.sets[name][:2]
+        if not os.path.isdir(folder):
+            return {}
+
+        sources = {}
+        for entry in os.listdir(folder):
+            match = self.pattern.search(entry)
+            if entry.startswith(prefix) and match:
+                path = os.path.join(folder, entry)
+                sources[match.group(1)] = (path, os.path.getmtime(path))
+
+        return sources
+
+    def conform(self, df, name, date):
+        country, columns = self.sets[name][2:]
+
+        if name == "cases_by_country":
+            df = Store().conform(df)
+        else:
+            # Registered here, at ingest, so whoever reads the file back knows every country in it
+            if country is not None:
+                registry.register(df[country])
+            df = df.reindex(columns=list(df.columns) + [column for column in columns if column not in df.columns])
+            df["statistic_taken_at"] = pd.to_datetime(df["statistic_taken_at"])
+            for column, dtype in columns.items():
+                values = df[column]
+                if not pd.api.types.is_numeric_dtype(values):
+                    values = pd.to_numeric(values.astype(str).str.replace(",", "", regex=False), errors="coerce")
+                if dtype.startswith("Int"):
+                    values = values.round()
+                df[column] = values.astype(dtype)
+
+        df.insert(0, "date", date)
+        return df.reset_index(drop=True)
+
+    def load(self):
+        mtime = self.mtime()
+        with self.lock:
+            if self.loaded is not None and self.loaded[0] == mtime:
+                return self.loaded
+
+        manifest = {}
+        if mtime != 0:
+            with open(os.path.join(self.path, "manifest.json")) as file:
+                manifest = json.load(file)
+
+        # The sets themselves are read on first use, see get_frame
+        with self.lock:
+            self.loaded = (mtime, manifest, {})
+            return self.loaded
+
+    def get_frame(self, name):
+        # A set's whole file and its days as a sorted array to search
+        mtime, manifest, frames = self.load()
+        with self.lock:
+            if name in frames:
+                return frames[name]
+
+        country = self.sets[name][2]
+        if manifest.get(name, {}).get("dates"):
+            df = pd.read_parquet(self.get_file(name))
+            if country is not None:
+                df[country] = registry.categorical(df[country])
+        else:
+            df = pd.DataFrame(columns=["date"])
+
+        with self.lock:
+            frames[name] = (df, df["date"].to_numpy(dtype="U10"))
+            return frames[name]
+
+    def compact(self):
+        # Rewrites the file of every set with new or changed pickles. Unchanged days are taken from the current file
+        manifest = dict(self.load()[1])
+        changed = False
+
+        for name in self.sets:
+            sources = self.get_sources(name)
+            entry = manifest.get(name, {})
+            known = entry.get("sources", {})
+
+            stale = sorted(date for date, (path, mtime) in sources.items() if known.get(date) != mtime)
+            if not stale and set(known) == set(sources):
+                continue
+
+            os.makedirs(self.path, exist_ok=True)
+            if sources:
+                frames = []
+                keep = sorted(set(sources) & set(known) - set(stale))
+                if keep:
+                    frames.append(pd.read_parquet(self.get_file(name), filters=[("date", "in", keep)]))
+                frames += [self.conform(pd.read_pickle(sources[date][0]), name, date) for date in stale]
+
+                df = pd.concat(frames, sort=False, ignore_index=True)
+                df = df.sort_values("date", kind="mergesort").reset_index(drop=True)
+
+                temp = os.path.join(self.path, ".%s.parquet.tmp" % name)
+                df.to_parquet(temp, index=False)
+                os.replace(temp, self.get_file(name))
+            elif os.path.isfile(self.get_file(name)):
+                os.remove(self.get_file(name))
+
+            manifest[name] = {"dates": sorted(sources),
+                              "sources": {date: mtime for date, (path, mtime) in sources.items()}}
+            changed = True
+            print("Compacted %d '%s' snapshots, %d new or changed" % (len(sources), name, len(stale)))
+
+        if changed:
+            temp = os.path.join(self.path, ".manifest.json.tmp")
+            with open(temp, "w") as file:
+                json.dump(manifest, file)
+            os.replace(temp, os.path.join(self.path, "manifest.json"))
+
+        return changed
+
+    def get_dates(self, name):
+        return self.load()[1].get(name, {}).get("dates", [])
+
+    def get_date(self, name, date=None):
+        # The newest snapshot day on or before date, None if there isn't one
+        dates = self.get_dates(name)
+        if date is None:
+            return dates[-1] if dates else None
+
+        i = bisect.bisect_right(dates, str(date)[:10])
+        return dates[i - 1] if i else None
+
+    def read(self, name, start_date=None, end_date=None, countries=None, columns=None):
+        # Every snapshot between two days, both inclusive, as one frame with the snapshot's day in "date". The country
+        # column is categorical with the country IDs as codes, so countries are matched by ID whatever their spelling
+        country = self.sets[name][2]
+        df, days = self.get_frame(name)
+        if not len(days):
+            return df
+
+        start = 0 if start_date is None else int(np.searchsorted(days, str(start_date)[:10], side="left"))
+        end = len(days) if end_date is None else int(np.searchsorted(days, str(end_date)[:10], side="right"))
+        df = df.iloc[start:end]
+
+        if countries is not None and country is not None:
+            ids = registry.get_ids(countries, register=False)
+            df = df.loc[np.isin(df[country].cat.codes.to_numpy(), ids[ids >= 0])]
+
+        if columns is not None:
+            df = df[["date"] + [column for column in [country, "statistic_taken_at"]
+                                if column is not None and column not in columns] + list(columns)]
+
+        return df.reset_index(drop=True)
+
+    def as_of(self, name, date=None, countries=None, columns=None):
+        # The newest snapshot on or before date, the newest of all without one
+        day = self.get_date(name, date)
+
+        # Without a snapshot on or before date this is a read of a day there is nothing for, i.e. an empty frame
+        return self.read(name, day or date, day or date, countries, columns)
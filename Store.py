@@ -0,0 +1,287 @@
+import json
+import os
+import os.path
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from Countries import registry
+
+"""
+Cleansed data for every country kept in a single Parquet data set partitioned by day, i.e.
+
+    data-frames/store/cleansed-data/date=2020-04-05/part.parquet
+
+Rows go into the partition of the day they were taken on (statistic_taken_at), and a refresh only rewrites the
+partitions of the days its rows were taken on, normally just today's, so adding a day's numbers costs one small
+file write instead of rewriting every country's full history. Partitions are written to a temporary file and
+renamed into place, so readers always see either the old or the new version of a day, never half of one.
+
+Countries are stored as their int32 ID in the registry (country_id, see Countries) rather than by name, so a read
+for some countries compares IDs whatever spelling they were asked for with, and read() maps the IDs back to the
+canonical names. Stores written with names before need rebuilding, see cl() in Data.
+
+Every day but the newest is also compacted into one file sorted by country ID, with the day it came from in "date":
+
+    data-frames/store/cleansed-data/_compacted.parquet
+
+A country's whole history is then a row group or two of one file rather than a few rows in every partition, and a
+read only opens the partitions that are newer than the compaction, usually just today's. The file keeps the mtime of
+each partition it was made from in its own metadata, a partition rewritten since is read from the partition instead.
+compact() runs after every upsert and only reads the partitions that are new or changed since the last one.
+
+Needs pyarrow (pip install pyarrow) for Parquet support and filtered reads.
+"""
+
+
+class Store:
+    keys = ["country_name", "region", "statistic_taken_at"]
+
+    # What the files hold instead of the keys, the country as its ID in the registry (see Countries)
+    stored = ["country_id", "region", "statistic_taken_at"]
+
+    columns = {"cases": "Int32", "deaths": "Int32", "total_recovered": "Int32", "new_deaths": "Int32",
+               "new_cases": "Int32", "serious_critical": "Int32", "active_cases": "Int32",
+               "total_cases_per_1m_population": "float32", "deaths/cases%": "float32", "recovered/cases%": "float32",
+               "active/cases%": "float32"}
+
+    def __init__(self, path="./data-frames/store/cleansed-data/"):
+        self.path = path
+
+    def get_partition(self, date):
+        return os.path.join(self.path, "date=%s" % date, "part.parquet")
+
+    def get_dates(self):
+        if not os.path.isdir(self.path):
+            return []
+
+        return sorted(name.split("=", 1)[1] for name in os.listdir(self.path) if name.startswith("date="))
+
+    def exists(self):
+        return os.path.isfile(os.path.join(self.path, "_updated"))
+
+    def mtime(self):
+        path = os.path.join(self.path, "_updated")
+        return os.path.getmtime(path) if os.path.isfile(path) else 0
+
+    def conform(self, df):
+        # Every partition has to share one schema so the data set can be read back as a whole
+        df = df.reindex(columns=self.keys + list(self.columns))
+
+        df["country_name"] = registry.canonicalize(df["country_name"].astype(str), register=True).astype(str)
+        df["region"] = df["region"].fillna("").astype(str)
+        df["statistic_taken_at"] = pd.to_datetime(df["statistic_taken_at"])
+
+        for column, dtype in self.columns.items():
+            values = df[column]
+            if not pd.api.types.is_numeric_dtype(values):
+                values = pd.to_numeric(values.astype(str).str.replace(",", "", regex=False), errors="coerce")
+            if dtype.startswith("Int"):
+                values = values.round()
+            df[column] = values.astype(dtype)
+
+        return df.reset_index(drop=True)
+
+    def to_stored(self, df):
+        # A conformed frame as it is written, its names are registered by conform
+        ids = registry.get_ids(df["country_name"])
+        df = df.drop(columns=["country_name"])
+        df.insert(0, "country_id", ids)
+        return df
+
+    def from_stored(self, df):
+        # IDs back to the canonical names, as the rest of the app knows countries
+        names = np.array(registry.get_names(), dtype=object)
+        ids = df["country_id"].to_numpy()
+        df = df.drop(columns=["country_id"])
+        df.insert(0, "country_name", pd.Series(names[ids], index=df.index, dtype="str"))
+        return df
+
+    def write_partition(self, df, date):
+        path = self.get_partition(date)
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # pyarrow skips hidden files, so a half written temp file is never read as part of the data set
+        temp = os.path.join(os.path.dirname(path), ".part.parquet.tmp")
+        df.to_parquet(temp, index=False)
+        os.replace(temp, path)
+
+    def mark_updated(self, date):
+        with open(os.path.join(self.path, "_updated"), "w") as file:
+            file.write(date)
+
+    def upsert(self, df):
+        # Each row replaces whatever the partition of the day it was taken on held for its country and region, the
+        # rest of the partition is kept. Returns the days written
+        df = self.conform(df)
+        if df.empty:
+            return []
+
+        df = self.to_stored(df)
+        days = []
+        for date, rows in df.groupby(df["statistic_taken_at"].dt.strftime("%Y-%m-%d")):
+            path = self.get_partition(date)
+            if os.path.isfile(path):
+                current = pd.read_parquet(path, columns=self.stored + list(self.columns))
+                replaced = pd.MultiIndex.from_frame(current[["country_id", "region"]]).isin(
+                    pd.MultiIndex.from_frame(rows[["country_id", "region"]]))
+                rows = pd.concat([current.loc[~replaced], rows], ignore_index=True)
+                rows = rows.sort_values(["country_id", "region", "statistic_taken_at"]).reset_index(drop=True)
+
+            self.write_partition(rows, date)
+            days.append(date)
+
+        self.compact()
+        self.mark_updated(days[-1])
+
+        return days
+
+    def upsert_many(self, df, workers=None):
+        # Rows are split into partitions by the day they were taken on and the partitions written side by side
+        df = self.conform(df)
+        if df.empty:
+            return
+
+        df = self.to_stored(df)
+        days = df.groupby(df["statistic_taken_at"].dt.strftime("%Y-%m-%d"))
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(lambda day: self.write_partition(day[1], day[0]), days))
+
+        self.compact()
+        self.mark_updated(max(days.groups))
+
+    def get_compacted(self):
+        return os.path.join(self.path, "_compacted.parquet")
+
+    def get_sources(self, dates):
+        # {date: mtime} of the partitions, leaving out any day whose first write hasn't been renamed into place yet
+        sources = {}
+        for date in dates:
+            try:
+                sources[date] = os.stat(self.get_partition(date)).st_mtime_ns
+            except FileNotFoundError:
+                pass
+
+        return sources
+
+    def get_compacted_sources(self, file):
+        # {date: mtime} of the partitions the compacted file was made from
+        return json.loads(pq.read_metadata(file).metadata[b"sources"])
+
+    def compact(self):
+        # Rewrites the compacted file if any day but the newest is new or changed. Unchanged days are taken from the
+        # current file
+        sources = self.get_sources(self.get_dates()[:-1])
+        path = self.get_compacted()
+
+        known = {}
+        if os.path.isfile(path):
+            known = self.get_compacted_sources(path)
+
+        stale = sorted(date for date, mtime in sources.items() if known.get(date) != mtime)
+        if not stale and set(known) == set(sources):
+            return False
+
+        if not sources:
+            os.remove(path)
+            return True
+
+        frames = []
+        keep = sorted(set(sources) & set(known) - set(stale))
+        if keep:
+            df = pd.read_parquet(path)
+            frames.append(df.loc[df["date"].isin(keep)])
+        for date in stale:
+            df = pd.read_parquet(self.get_partition(date), columns=self.stored + list(self.columns))
+            df["date"] = date
+            frames.append(df)
+
+        df = pd.concat(frames, sort=False, ignore_index=True)
+        df = df.sort_values(["country_id", "statistic_taken_at"], kind="mergesort")
+
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        table = table.replace_schema_metadata(dict(table.schema.metadata, sources=json.dumps(sources)))
+
+        # Through a temp file of its own, a reader holding the file open keeps reading the version it opened
+        descriptor, temp = tempfile.mkstemp(prefix="._compacted.parquet.", suffix=".tmp", dir=self.path)
+        os.close(descriptor)
+        try:
+            pq.write_table(table, temp, row_group_size=8192)
+            os.replace(temp, path)
+        except BaseException:
+            os.remove(temp)
+            raise
+
+        print("Compacted %d 'cleansed data' partitions, %d new or changed" % (len(sources), len(stale)))
+        return True
+
+    def read(self, countries=None, columns=None, start_date=None, end_date=None):
+        if not self.exists():
+            return self.conform(pd.DataFrame(columns=self.keys))
+
+        # Only the days asked for are ever opened, and countries are filtered as each file is read
+        start = None if start_date is None else str(start_date)[:10]
+        end = None if end_date is None else str(end_date)[:10]
+        sources = self.get_sources(date for date in self.get_dates()
+                                   if (start is None or date >= start) and (end is None or date <= end))
+
+        # Countries are matched by ID, whatever their spelling. Names the registry doesn't know have no data
+        filters = []
+        if countries is not None:
+            ids = registry.get_ids(countries)
+            filters.append(("country_id", "in", [int(i) for i in np.unique(ids[ids >= 0])]))
+
+        # Always a list, pyarrow would otherwise add the day back as a column from the folder names
+        columns = self.stored + list(self.columns) if columns is None else \
+            [column for column in self.stored if column not in columns] + list(columns)
+
+        frames = []
+        try:
+            # Metadata and rows from the same open file, a compaction renaming a new one into place meanwhile can't
+            # mix the days of one with the rows of the other
+            with open(self.get_compacted(), "rb") as file:
+                known = self.get_compacted_sources(file)
+                stale = {date for date, mtime in sources.items() if date in known and known[date] != mtime}
+
+                dates = [("date", ">=", start)] if start is not None else []
+                dates += [("date", "<=", end)] if end is not None else []
+                df = pd.read_parquet(file, columns=columns + ["date"] if stale else columns,
+                                     filters=filters + dates or None)
+        except FileNotFoundError:
+            known = {}
+        else:
+            if stale:
+                df = df.loc[~df["date"].isin(stale), columns]
+            frames.append(df)
+            sources = {date: mtime for date, mtime in sources.items() if date in stale or date not in known}
+
+        if sources:
+            frames.append(pd.read_parquet([self.get_partition(date) for date in sources], columns=columns,
+                                          filters=filters or None))
+
+        if not frames:
+            return self.conform(pd.DataFrame(columns=self.keys))
+
+        df = self.from_stored(pd.concat(frames, sort=False, ignore_index=True))
+        return df.sort_values(["country_name", "statistic_taken_at"]).reset_index(drop=True)
+
+    def get_countries(self):
+        # The countries there is data for, from the keys alone
+        return list(self.read(columns=[])["country_name"].unique())
+
+    def import_pickles(self, path="./data-frames/cleansed-data/"):
+        # One off migration from the old one pickle per country layout
+        frames = []
+        for name in sorted(os.listdir(path)):
+            if name.endswith(".pkl"):
+                df = pd.read_pickle(os.path.join(path, name))
+                df["country_name"] = name[:-len(".pkl")]
+                frames.append(df)
+
+        print("Importing 'cleansed data' from %d pickles" % len(frames))
+        self.upsert_many(pd.concat(frames, sort=False))
@@ -0,0 +1,76 @@
+import os
+import os.path
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from Metrics import metrics
+
+"""
+Writes the data frames of a refresh on a small pool of threads, so fetching and parsing the next response doesn't
+wait on pickling and writing the last one. Every file is written next to its target and renamed over it, a reader
+sees the old file or the new one, never half of one.
+
+Once a refresh has written everything it marks a new version,
+
+    data-frames/VERSION    time the refresh finished writing, in nanoseconds
+
+a single file readers can key their caches on instead of checking every file a refresh may have touched.
+"""
+
+
+class Writer:
+    version_path = "./data-frames/VERSION"
+
+    def __init__(self, workers=4):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="writer")
+        self.pending = []
+        self.written = 0
+        self.lock = threading.Lock()
+
+    @metrics.timed("write", "path")
+    def write(self, df, path):
+        directory, name = os.path.split(path)
+        temp = os.path.join(directory, ".%s.tmp" % name)
+        df.to_pickle(temp)
+        os.replace(temp, path)
+
+        with self.lock:
+            self.written += 1
+        metrics.inc("covid_written_files_total")
+
+    def submit(self, df, path):
+        # The frame mustn't be changed afterwards, it is pickled whenever a thread gets to it
+        future = self.pool.submit(self.write, df, path)
+        with self.lock:
+            self.pending.append(future)
+
+        return future
+
+    def wait(self):
+        # Blocks until everything submitted so far is on disk, then raises the first error there was, if any
+        with self.lock:
+            pending, self.pending = self.pending, []
+
+        errors = [future.exception() for future in pending]
+        errors = [error for error in errors if error is not None]
+        if errors:
+            raise errors[0]
+
+    def mark_version(self):
+        self.wait()
+
+        temp = os.path.join(os.path.dirname(self.version_path), ".VERSION.tmp")
+        with open(temp, "w") as file:
+            file.write("%d\n" % time.time_ns())
+        os.replace(temp, self.version_path)
+
+    @classmethod
+    def get_version(cls):
+        return os.path.getmtime(cls.version_path) if os.path.isfile(cls.version_path) else 0
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            self.pool.shutdown()
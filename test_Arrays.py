@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from Arrays import Arrays
+
+"""
+The exported arrays: the newest row of each country, or the newest on or before a date, for many countries at once.
+
+    python -m pytest test_Arrays.py
+"""
+
+
+@pytest.fixture
+def arrays(tmp_path, monkeypatch):
+    # The country registry lives under the working directory too
+    monkeypatch.chdir(tmp_path)
+    arrays = Arrays()
+    arrays.export(pd.concat([get_frame("Italy", "2020-04-01", [1, 2, 3]),
+                             get_frame("UK", "2020-04-03", [10, 20, 30, 40]),
+                             get_frame("Spain", "2020-04-02", [5])], ignore_index=True))
+    return arrays
+
+
+def get_frame(country, start, cases):
+    df = pd.DataFrame({"country_name": country, "region": "",
+                       "statistic_taken_at": pd.date_range(start, periods=len(cases)) + pd.Timedelta(hours=12),
+                       "cases": pd.array(cases, dtype="Int32")})
+    for column in Arrays.columns:
+        if column not in df:
+            df[column] = np.nan
+    return df
+
+
+def test_newest_rows(arrays):
+    dates, values = arrays.get_latest(["UK", "Italy", "Spain"], ["cases", "deaths"])
+
+    assert dates.tolist() == [np.datetime64("2020-04-06"), np.datetime64("2020-04-03"), np.datetime64("2020-04-02")]
+    assert values[:, 0].tolist() == [40, 3, 5]
+    assert np.isnan(values[:, 1]).all()
+
+
+def test_rows_as_of_a_date(arrays):
+    dates, values = arrays.get_latest(["UK", "Italy", "Spain"], ["cases"], date="2020-04-04")
+
+    assert dates.tolist() == [np.datetime64("2020-04-04"), np.datetime64("2020-04-03"), np.datetime64("2020-04-02")]
+    assert values[:, 0].tolist() == [20, 3, 5]
+
+
+def test_countries_without_a_row(arrays):
+    # UK's first row is after the date, the previous country's rows must not be picked up instead
+    dates, values = arrays.get_latest(["Atlantis", "UK", "Italy"], ["cases"], date="2020-04-02")
+
+    assert np.isnat(dates[:2]).all() and dates[2] == np.datetime64("2020-04-02")
+    assert np.isnan(values[:2, 0]).all() and values[2, 0] == 2
+
+    dates, values = arrays.get_latest(["Italy"], ["cases"], date="2020-03-01")
+    assert np.isnat(dates).all() and np.isnan(values).all()
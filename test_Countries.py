@@ -0,0 +1,61 @@
+import unicodedata
+
+import numpy as np
+import pytest
+
+from Countries import Countries
+
+"""
+Spellings of one country resolving to one ID, and IDs staying the same from one run to the next.
+
+    python -m pytest test_Countries.py
+"""
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "countries.json")
+
+
+def test_spellings_and_aliases_are_one_country(path):
+    countries = Countries(path)
+    countries.register(["UK", "Curaçao", "Réunion"])
+
+    ids = countries.get_ids(["UK", "United_Kingdom", "united kingdom", "Great Britain"])
+    assert len(set(ids)) == 1 and ids[0] >= 0
+    assert len(set(countries.get_ids(["Curaçao", "Curacao", "CURAÇAO"]))) == 1
+    # Decomposed, an "e" and a combining accent
+    assert countries.get_ids(["Réunion"])[0] == countries.get_ids(["Réunion"])[0]
+    assert list(countries.canonicalize(["United_Kingdom", "curacao"])) == ["UK", "Curaçao"]
+
+
+def test_ids_are_stable_across_instances(path):
+    first = Countries(path)
+    first.register(["Italy", "Spain"])
+    ids = first.get_ids(["Italy", "Spain"])
+
+    second = Countries(path)
+    second.register(["Atlantis"])
+    assert np.array_equal(second.get_ids(["Italy", "Spain"]), ids)
+
+    # The first instance reads the file again once it has changed, and new names come after the old ones
+    assert first.get_ids(["Atlantis"])[0] > ids.max()
+
+
+def test_only_registering_adds_names(path):
+    countries = Countries(path)
+
+    assert countries.get_ids(["Atlantis", None])[0] == -1
+    assert countries.get_ids([None])[0] == -1
+    assert not countries.isin(["Atlantis"], ["Atlantis"]).any()
+    assert countries.isin(["Atlantis"], ["atlantis"], register=True).all()
+    assert countries.get_ids(["Atlantis"])[0] >= 0
+
+
+def test_categorical_codes_are_the_ids(path):
+    countries = Countries(path)
+    countries.register(["Italy", "UK"])
+
+    categorical = countries.categorical(["United_Kingdom", "Italy", "Atlantis"])
+    assert list(categorical.codes) == list(countries.get_ids(["UK", "Italy", "Atlantis"]))
+    assert list(categorical[:2]) == ["UK", "Italy"]
@@ -0,0 +1,73 @@
+import http.client
+
+import pandas as pd
+import pytest
+
+from Benchmarks import StubServer, history_payload, new_data
+
+"""
+Data.request against the benchmarks' stub server: what is retried, what isn't and what is returned as data. And
+what Data.sanitize makes of the API's numbers.
+
+    python -m pytest test_Data.py
+"""
+
+path = "/coronavirus/cases_by_particular_country.php?country=UK"
+
+
+@pytest.fixture
+def server():
+    server = StubServer().start()
+    server.payloads[path] = history_payload(10)
+    yield server
+    server.stop()
+
+
+def get_data(server, retries=2):
+    data = new_data(server)
+    data.retries = retries
+    return data
+
+
+def test_rate_limits_and_server_errors_are_retried(server):
+    server.statuses[path] = [429, 503]
+
+    assert get_data(server).request(path) == server.payloads[path]
+    assert server.requests == 3
+
+
+def test_retries_give_up(server):
+    server.statuses[path] = [503, 503, 503]
+
+    with pytest.raises(http.client.HTTPException, match="returned 503 after 3 attempts"):
+        get_data(server).request(path)
+    assert server.requests == 3
+
+
+@pytest.mark.parametrize("status", [400, 401, 403, 404])
+def test_client_errors_raise_without_retrying(server, status):
+    server.statuses[path] = [status]
+
+    with pytest.raises(http.client.HTTPException, match="returned %d" % status):
+        get_data(server).request(path)
+    assert server.requests == 1
+
+
+def test_unknown_paths_are_not_data(server):
+    with pytest.raises(http.client.HTTPException, match="returned 404"):
+        get_data(server).request("/coronavirus/nowhere.php")
+
+
+def test_sanitize_parses_mixed_and_missing_values():
+    data = new_data()
+    df = pd.DataFrame({"cases": pd.Series([12, "1,234", "", "N/A", None], dtype=object),
+                       "total_cases_per_1m_population": ["1.5", "2,000.25", "", "", "3"]})
+
+    df = data.sanitize(df, "cases_by_country")
+
+    assert df["cases"].dtype == "Int32"
+    assert df["cases"].tolist() == [12, 1234, pd.NA, pd.NA, pd.NA]
+    assert df["total_cases_per_1m_population"].dtype == "float32"
+    assert df["total_cases_per_1m_population"].iloc[[0, 1, 4]].tolist() == [1.5, 2000.25, 3]
+    # "" and "N/A" aren't numbers, a missing value is just missing
+    assert data.coerced["cases_by_country"] == 4
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+from Downsample import downsample, lttb, min_max
+
+"""
+The point budget of both decimation methods and the points they have to keep.
+
+    python -m pytest test_Downsample.py
+"""
+
+
+def get_series(n=1000, seed=0):
+    rng = np.random.RandomState(seed)
+    return np.arange(n, dtype="float64"), rng.normal(size=n).cumsum()
+
+
+@pytest.mark.parametrize("method", [lttb, min_max])
+@pytest.mark.parametrize("points", [4, 10, 99, 500])
+def test_endpoints_are_kept_and_the_budget_respected(method, points):
+    x, y = get_series()
+    kept = method(x, y, points)
+
+    assert kept[0] == 0 and kept[-1] == len(y) - 1
+    assert len(kept) <= points
+    assert np.all(np.diff(kept) > 0)
+
+
+def test_lttb_uses_the_whole_budget():
+    x, y = get_series()
+
+    assert len(lttb(x, y, 100)) == 100
+
+
+def test_min_max_keeps_every_peak():
+    x, y = get_series()
+    y[123], y[777] = 1000, -1000
+
+    kept = min_max(x, y, 20)
+    assert 123 in kept and 777 in kept
+
+
+@pytest.mark.parametrize("method", [lttb, min_max])
+def test_short_series_are_left_alone(method):
+    x, y = get_series(50)
+
+    assert np.array_equal(method(x, y, 100), np.arange(50))
+
+
+@pytest.mark.parametrize("method", ["lttb", "minmax"])
+def test_missing_values_are_skipped(method):
+    x, y = get_series()
+    y[::7] = np.nan
+
+    kept = downsample(x, y, 100, method)
+    assert not np.isnan(y[kept]).any()
+    assert kept[0] == 1 and kept[-1] == len(y) - 1
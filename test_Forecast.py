@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+import Forecast
+from Forecast import FitCache
+
+"""
+The fit cache: a repeat fit of the same data is a hit, data that grew by a day starts from the previous parameters,
+and fits seeded by Forecast.run or saved by another process are found.
+
+    python -m pytest test_Forecast.py
+"""
+
+y = np.arange(1, 31, dtype="float64") ** 1.5 + 3
+
+
+@pytest.fixture
+def fits(tmp_path):
+    return FitCache(path=str(tmp_path / "fit-cache.pkl"))
+
+
+def test_fits_are_cached_and_warm_started(fits):
+    popt, popc, projection = fits.fit("UK", "cases", Forecast.exp, "2020-03-01", y[:-1], 7)
+    assert (fits.hits, fits.warm_starts, fits.misses) == (0, 0, 1)
+    assert len(projection) == len(y) - 1 + 7
+
+    fits.fit("UK", "cases", Forecast.exp, "2020-03-01", y, 7)
+    assert (fits.hits, fits.warm_starts, fits.misses) == (0, 1, 1)
+
+    cached = fits.fit("UK", "cases", Forecast.exp, "2020-03-01", y[:-1], 7)
+    assert (fits.hits, fits.warm_starts, fits.misses) == (1, 1, 1)
+    assert np.array_equal(cached[0], popt)
+    assert np.allclose(cached[2], projection)
+
+
+def test_other_keys_are_fitted_again(fits):
+    fits.fit("UK", "cases", Forecast.exp, "2020-03-01", y, 7)
+    fits.fit("UK", "deaths", Forecast.exp, "2020-03-01", y, 7)
+    fits.fit("UK", "cases", Forecast.exp, "2020-03-02", y, 7)
+
+    assert (fits.hits, fits.warm_starts, fits.misses) == (0, 0, 3)
+
+
+def test_seeded_fits_are_shared_through_the_file(fits):
+    fits.seed([Forecast.fit_row("UK", "cases", "exp", "2020-03-01", 7, y),
+               Forecast.fit_row("UK", "cases", "exp", "2020-03-01", 7, y[:2])])
+
+    other = FitCache(path=fits.path)
+    other.fit("UK", "cases", Forecast.exp, "2020-03-01", y, 7)
+
+    assert (other.hits, other.warm_starts, other.misses) == (1, 0, 0)
@@ -0,0 +1,73 @@
+import pytest
+
+from Graphs import FigureCache
+
+"""
+The figure cache: entries are only served for the data version they were built from, and the ETag follows the JSON.
+
+    python -m pytest test_Graphs.py
+"""
+
+
+@pytest.fixture
+def figures():
+    return FigureCache(max_entries=2)
+
+
+def get_build(figure, built):
+    def build():
+        built.append(figure)
+        return figure
+
+    return build
+
+
+def test_a_repeat_request_is_not_built_again(figures):
+    built = []
+    first = figures.get("uk", 1.0, get_build('{"data": []}', built))
+    second = figures.get("uk", 1.0, get_build('{"data": []}', built))
+
+    assert second is first and len(built) == 1
+    assert figures.stats() == {"hits": 1, "misses": 1, "entries": 1}
+
+
+def test_a_newer_version_drops_every_entry(figures):
+    built = []
+    figures.get("uk", 1.0, get_build('{"data": [1]}', built))
+    figures.get("italy", 1.0, get_build('{"data": [2]}', built))
+
+    entry = figures.get("uk", 2.0, get_build('{"data": [3]}', built))
+
+    assert entry["json"] == '{"data": [3]}' and entry["version"] == 2.0
+    assert figures.stats()["entries"] == 1
+
+
+def test_a_figure_built_from_an_older_version_is_served_but_not_kept(figures):
+    figures.get("uk", 2.0, get_build('{"data": [2]}', []))
+
+    entry = figures.get("italy", 1.0, get_build('{"data": [1]}', []))
+
+    assert entry["json"] == '{"data": [1]}'
+    assert figures.stats()["entries"] == 1
+
+
+def test_etags_follow_the_json(figures):
+    uk = figures.get("uk", 1.0, get_build('{"data": [1]}', []))
+    same = figures.get("uk-again", 1.0, get_build('{"data": [1]}', []))
+    italy = figures.get("italy", 1.0, get_build('{"data": [2]}', []))
+
+    assert uk["etag"] == same["etag"] != italy["etag"]
+    assert uk["last_modified"] == same["last_modified"]
+
+
+def test_least_recently_used_entries_go_first(figures):
+    figures.get("uk", 1.0, get_build("1", []))
+    figures.get("italy", 1.0, get_build("2", []))
+    figures.get("uk", 1.0, get_build("1", []))
+    figures.get("spain", 1.0, get_build("3", []))
+
+    built = []
+    figures.get("uk", 1.0, get_build("1", built))
+    figures.get("italy", 1.0, get_build("2", built))
+
+    assert built == ["2"]
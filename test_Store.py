@@ -0,0 +1,78 @@
+import os
+import time
+
+import pandas as pd
+import pytest
+
+from Store import Store
+
+"""
+The day partitioned store and its compacted file: rows land in the partition of the day they were taken on, a
+partition rewritten after a compaction wins over the compacted rows, and reads are pruned by day and country.
+
+    python -m pytest test_Store.py
+"""
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    # The country registry lives under the working directory too
+    monkeypatch.chdir(tmp_path)
+    return Store()
+
+
+def get_frame(country, days, start="2020-04-01", cases=0):
+    return pd.DataFrame({"country_name": country, "region": "",
+                         "statistic_taken_at": pd.date_range(start, periods=days) + pd.Timedelta(hours=12),
+                         "cases": range(cases, cases + days)})
+
+
+def get_day(df, date):
+    return df.loc[df["statistic_taken_at"].dt.strftime("%Y-%m-%d") == date]
+
+
+def test_rows_land_in_the_partition_of_their_day(store):
+    store.upsert(get_frame("UK", 2, start="2020-04-06"))
+
+    assert store.get_dates() == ["2020-04-06", "2020-04-07"]
+    assert list(store.read(start_date="2020-04-07", end_date="2020-04-07")["cases"]) == [1]
+
+
+def test_upsert_replaces_only_its_countries(store):
+    store.upsert(pd.concat([get_frame("UK", 1), get_frame("Italy", 1)]))
+    store.upsert(get_frame("UK", 1, cases=100))
+
+    df = store.read()
+    assert sorted(zip(df["country_name"], df["cases"])) == [("Italy", 0), ("UK", 100)]
+
+
+def test_older_days_are_compacted_and_read_back(store):
+    store.upsert_many(pd.concat([get_frame("UK", 10), get_frame("Italy", 10)]))
+
+    assert os.path.isfile(store.get_compacted())
+    assert not store.compact()
+
+    df = store.read(countries=["United_Kingdom"])
+    assert list(df["country_name"].unique()) == ["UK"]
+    assert list(df["cases"]) == list(range(10))
+    assert len(store.read(start_date="2020-04-03", end_date="2020-04-05")) == 6
+
+
+def test_a_rewritten_partition_wins_over_the_compacted_rows(store):
+    store.upsert_many(get_frame("UK", 10))
+
+    # Past the mtime resolution of the file system, so the rewrite can be told apart
+    time.sleep(0.01)
+    store.upsert(get_frame("UK", 1, start="2020-04-03", cases=100))
+
+    assert list(get_day(store.read(), "2020-04-03")["cases"]) == [100]
+    assert list(get_day(store.read(countries=["UK"], start_date="2020-04-02"), "2020-04-03")["cases"]) == [100]
+    assert len(store.read()) == 10
+
+
+def test_unknown_countries_read_nothing(store):
+    store.upsert_many(get_frame("UK", 3))
+
+    df = store.read(countries=["Atlantis"])
+    assert df.empty and list(df.columns) == store.keys + list(store.columns)
+    assert store.get_countries() == ["UK"]
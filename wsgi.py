@@ -0,0 +1,29 @@
+import importlib.util
+import os
+import sys
+
+"""
+Production entry point. The Flask dev server handles one request at a time, behind gunicorn every worker process
+keeps its own in memory data and figure caches and serves them from several threads, e.g.
+
+    gunicorn --workers 4 --threads 8 --bind 0.0.0.0:8000 wsgi:app
+
+Data refreshes are not run inside the workers, otherwise every worker would call the API. Run one refresher next
+to them instead:
+
+    RAPIDAPI_KEY=... python Scheduler.py
+
+The workers notice a refresh through the store's modification time and rebuild their caches on the next request.
+"""
+
+os.environ.setdefault("REFRESH_IN_APP", "0")
+
+# The app's file name isn't a valid module name, so it is loaded from its path. Flask finds templates and static files
+# next to the module it is looked up by name in sys.modules, without the entry it would use the working directory
+spec = importlib.util.spec_from_file_location("tracker", os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                      "Covid-19-Tracker.py"))
+tracker = importlib.util.module_from_spec(spec)
+sys.modules[spec.name] = tracker
+spec.loader.exec_module(tracker)
+
+app = tracker.app